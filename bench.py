@@ -0,0 +1,791 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+#
+# pylint: disable=invalid-name,no-member,too-many-instance-attributes,too-many-locals,redefined-outer-name
+
+"""Benchmark the routes against a fake IPFS daemon.
+
+The app is served from this process using a throwaway database, and talks to
+an in-process fake of the IPFS HTTP API that answers every command after a
+configurable latency, so the numbers do not depend on go-ipfs or the DHT.
+
+Each scenario sends a number of requests at a fixed concurrency and reports
+the latency percentiles, throughput, database queries and IPFS calls per
+request, and the peak RSS of this process, which includes the fake daemon
+and the client. Queries made while a response is streamed are not counted.
+
+    ./env/bin/python bench.py --database postgresql:///stomata_bench \\
+        --pins 100000 --concurrency 16 pinList hashMetadata
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import hashlib
+import argparse
+import resource
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, urljoin, urlparse
+
+import requests
+from werkzeug.serving import WSGIRequestHandler, make_server
+from prometheus_client import REGISTRY
+from sqlalchemy import literal
+
+from stomata import app, create_schema, db
+from stomata.auth import check_secret, hash_secret, invalidate_api_key, lookup_api_key
+from stomata.models import ApiKey, Ipfs, IpfsAttr
+from stomata.worker import rebuild_usage
+from stomata_client import StomataClient
+
+SEED_PREFIX = "QmBench"
+SEED_API_KEYS = 100
+
+
+def _fake_hash(digest: bytes) -> str:
+    """ make something that looks like a CIDv0 from a digest """
+    return "Qm" + digest.hex()[:44]
+
+
+class FakeIpfsDaemon:
+    """Answers the IPFS HTTP API commands used by stomata.
+
+    Added content is hashed but not stored, and ``cat`` returns zeros of the
+    same size.
+    """
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.pins: Dict[str, str] = {}
+        self.sizes: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add(self, args: Dict[str, List[str]], body: Iterator[bytes]) -> Any:
+        """ hash an added file, without keeping it """
+        digest = hashlib.sha256()
+        size = 0
+        for buf in body:
+            digest.update(buf)
+            size += len(buf)
+        ipfs_hash = _fake_hash(digest.digest())
+        if args.get("only-hash", ["false"])[0] != "true":
+            with self._lock:
+                self.sizes[ipfs_hash] = size
+                if args.get("pin", ["true"])[0] == "true":
+                    self.pins[ipfs_hash] = "recursive"
+        return {"Name": ipfs_hash, "Hash": ipfs_hash, "Size": str(size)}
+
+    def pin_add(self, args: Dict[str, List[str]], _: Iterator[bytes]) -> Any:
+        """ pin objects """
+        with self._lock:
+            for ipfs_hash in args.get("arg", []):
+                self.pins[ipfs_hash] = "recursive"
+        return {"Pins": args.get("arg", [])}
+
+    def pin_rm(self, args: Dict[str, List[str]], _: Iterator[bytes]) -> Any:
+        """ unpin objects """
+        with self._lock:
+            for ipfs_hash in args.get("arg", []):
+                self.pins.pop(ipfs_hash, None)
+        return {"Pins": args.get("arg", [])}
+
+    def pin_ls(self, _: Dict[str, List[str]], __: Iterator[bytes]) -> Any:
+        """ list the pins """
+        with self._lock:
+            return {"Keys": {key: {"Type": value} for key, value in self.pins.items()}}
+
+    def object_stat(self, args: Dict[str, List[str]], _: Iterator[bytes]) -> Any:
+        """ get the size of an object """
+        ipfs_hash = args["arg"][0]
+        size = self.sizes.get(ipfs_hash, 0)
+        return {"Hash": ipfs_hash, "CumulativeSize": size, "DataSize": size}
+
+    def repo_stat(self, _: Dict[str, List[str]], __: Iterator[bytes]) -> Any:
+        """ get the size of the added content """
+        with self._lock:
+            size = sum(self.sizes.values())
+        return {
+            "RepoSize": size,
+            "StorageMax": 10 * size,
+            "NumObjects": len(self.sizes),
+            "RepoPath": "/tmp/fake",
+            "Version": "fs-repo@10",
+        }
+
+    def repo_gc(self, _: Dict[str, List[str]], __: Iterator[bytes]) -> Any:
+        """ collect garbage, which there never is """
+        return {}
+
+    def name_publish(self, args: Dict[str, List[str]], _: Iterator[bytes]) -> Any:
+        """ publish to the node key """
+        return {"Name": "k51fake", "Value": args["arg"][0]}
+
+    def key_list(self, _: Dict[str, List[str]], __: Iterator[bytes]) -> Any:
+        """ list the keys, which is just the node key """
+        return {"Keys": [{"Name": "self", "Id": "k51fake"}]}
+
+    def version(self, _: Dict[str, List[str]], __: Iterator[bytes]) -> Any:
+        """ get a version the client supports """
+        return {"Version": "0.7.0", "Commit": "", "Repo": "10", "System": "fake"}
+
+    def id(self, _: Dict[str, List[str]], __: Iterator[bytes]) -> Any:
+        """ get the node ID """
+        return {"ID": "12D3KooWFake", "Addresses": []}
+
+
+class _FakeIpfsHandler(BaseHTTPRequestHandler):
+    """ the HTTP side of the fake daemon """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args: Any) -> None:  # pylint: disable=arguments-differ
+        pass
+
+    def _body(self) -> Iterator[bytes]:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    return
+                yield self.rfile.read(size)
+                self.rfile.readline()
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining > 0:
+            buf = self.rfile.read(min(remaining, 0x100000))
+            if not buf:
+                return
+            remaining -= len(buf)
+            yield buf
+
+    def _file_body(self) -> Iterator[bytes]:
+        """ the content of the single file in a multipart body """
+        boundary = self.headers.get_param("boundary", header="Content-Type")
+        closing = "\r\n--{}--\r\n".format(boundary).encode()
+        head = b""
+        tail = b""
+        started = False
+        for buf in self._body():
+            if not started:
+                head += buf
+                idx = head.find(b"\r\n\r\n")
+                if idx < 0:
+                    continue
+                buf = head[idx + 4 :]
+                started = True
+            buf = tail + buf
+            if len(buf) > len(closing):
+                yield buf[: -len(closing)]
+                buf = buf[-len(closing) :]
+            tail = buf
+        if tail.endswith(closing):
+            tail = tail[: -len(closing)]
+        yield tail
+
+    def _send(self, status: int, content_type: str, blob: bytes) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(blob)))
+        self.end_headers()
+        self.wfile.write(blob)
+
+    def do_POST(self) -> None:
+        """ run an API command """
+        daemon: FakeIpfsDaemon = self.server.daemon  # type: ignore
+        time.sleep(daemon.latency)
+        url = urlparse(self.path)
+        args = parse_qs(url.query)
+        command = url.path[len("/api/v0/") :].replace("/", "_")
+
+        # stream zeros, as the content is not kept
+        if command == "cat":
+            for _ in self._body():
+                pass
+            size = daemon.sizes.get(args["arg"][0], 0)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            buf = bytes(0x100000)
+            while size > 0:
+                self.wfile.write(buf[: min(size, len(buf))])
+                size -= len(buf)
+            return
+
+        func: Optional[Callable[..., Any]] = getattr(daemon, command, None)
+        if not func:
+            for _ in self._body():
+                pass
+            blob = json.dumps(
+                {"Message": "unknown command", "Code": 0, "Type": "error"}
+            )
+            self._send(404, "application/json", blob.encode())
+            return
+        body = self._file_body() if command == "add" else self._body()
+        result = func(args, body)
+        for _ in body:
+            pass
+        self._send(200, "application/json", json.dumps(result).encode() + b"\n")
+
+
+class _KeepAliveHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+
+def _serve(server: Any) -> str:
+    """ serve requests on a thread, returning the port """
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def _parse_size(value: str) -> int:
+    """ parse a size such as 1K, 10M or 4G """
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    if value[-1:].upper() in units:
+        return int(float(value[:-1]) * units[value[-1:].upper()])
+    return int(value)
+
+
+def _multipart_file(size: int, boundary: str) -> Iterator[bytes]:
+    """Generate an upload of a file with unique content, without keeping it.
+
+    Only the first bytes are random, so large sizes cost nothing to make.
+    """
+    yield (
+        '--{}\r\nContent-Disposition: form-data; name="file"; filename="bench.bin"'
+        "\r\nContent-Type: application/octet-stream\r\n\r\n".format(boundary)
+    ).encode()
+    header = os.urandom(min(16, size))
+    yield header
+    remaining = size - len(header)
+    buf = bytes(0x100000)
+    while remaining > 0:
+        yield buf[: min(remaining, len(buf))]
+        remaining -= len(buf)
+    yield "\r\n--{}--\r\n".format(boundary).encode()
+
+
+def _metric_total(name: str) -> float:
+    """ get the sum of a metric over all the labels """
+    total = 0.0
+    for metric in REGISTRY.collect():
+        for sample in metric.samples:
+            if sample.name == name:
+                total += sample.value
+    return total
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class Benchmark:
+    """ runs the scenarios against the app served from this process """
+
+    def __init__(self, args: Any, host: str, daemon: FakeIpfsDaemon) -> None:
+        self.args = args
+        self.host = host
+        self.daemon = daemon
+        self.client = StomataClient(
+            host,
+            app.config["STOMATA_API_KEY"],
+            app.config["STOMATA_SECRET_API_KEY"],
+            pool_size=args.concurrency,
+            retries=0,
+        )
+        self.client.session.hooks["response"].append(self._count_response)
+        self.seeded: List[str] = []
+        self.transferred = 0
+        self._lock = threading.Lock()
+
+    def _count(self, length: int) -> None:
+        with self._lock:
+            self.transferred += length
+
+    def _count_response(self, r: requests.Response, **kwargs: Any) -> None:
+        """ count the bytes of each request, and of each response not streamed """
+        self._count(int(r.request.headers.get("Content-Length", 0)))
+        if not kwargs.get("stream"):
+            self._count(len(r.content))
+
+    def _call(self, method: str, path: str, **kwargs: Any) -> requests.Response:
+        """ make a request, streaming the response so large bodies are not kept """
+        r = self.client.session.request(
+            method,
+            urljoin(self.host, path),
+            timeout=self.client.timeout,
+            stream=True,
+            **kwargs
+        )
+        for buf in r.iter_content(0x10000):
+            self._count(len(buf))
+        return r
+
+    def _random_hash(self) -> str:
+        return random.choice(self.seeded)
+
+    def _pop_hash(self) -> str:
+        with self._lock:
+            return self.seeded.pop()
+
+    def seed(self, count: int) -> None:
+        """ add pins until there are at least count, then rebuild the usage """
+        prefix: Any = Ipfs.pin_hash
+        with app.app_context():
+            create_schema()
+            existing = (
+                db.session.query(Ipfs.pin_hash)
+                .filter(prefix.like("{}%".format(SEED_PREFIX)))
+                .count()
+            )
+            ipfs_id: Any = Ipfs.ipfs_id
+            max_id = db.session.query(db.func.max(ipfs_id)).scalar() or 0
+            start = time.perf_counter()
+            user_id = app.config["ADMIN_EMAIL"]
+            for i in range(existing, count, 10000):
+                db.session.execute(
+                    Ipfs.__table__.insert(),
+                    [
+                        {
+                            "pin_hash": "{}{:040d}".format(SEED_PREFIX, j),
+                            "user_id": user_id,
+                            "name": "bench-{}.cab".format(j),
+                            "size": 1024,
+                        }
+                        for j in range(i, min(i + 10000, count))
+                    ],
+                )
+            if count > existing:
+                # one in a thousand pins have the same source, to test filtering
+                db.session.execute(
+                    IpfsAttr.__table__.insert().from_select(
+                        ["ipfs_id", "key", "value"],
+                        db.session.query(
+                            ipfs_id,
+                            literal("source"),
+                            literal("bench-") + db.cast(ipfs_id % 1000, db.String),
+                        )
+                        .filter(ipfs_id > max_id)
+                        .subquery(),
+                    )
+                )
+                db.session.commit()
+
+                # the counters are kept using PostgreSQL upserts
+                if db.engine.dialect.name == "postgresql":
+                    rebuild_usage()
+                print(
+                    "seeded {} pins in {:.1f}s".format(
+                        count - existing, time.perf_counter() - start
+                    )
+                )
+            if not db.session.query(ApiKey).first():
+                db.session.execute(
+                    ApiKey.__table__.insert(),
+                    [
+                        {
+                            "api_key": "bench-{}".format(i),
+                            "secret_hash": hash_secret("bench-secret-{}".format(i)),
+                            "user_id": "bench-{}@example.com".format(i),
+                        }
+                        for i in range(SEED_API_KEYS)
+                    ],
+                )
+                db.session.commit()
+            self.seeded = [
+                pin_hash
+                for (pin_hash,) in db.session.query(Ipfs.pin_hash)
+                .filter(prefix.like("{}%".format(SEED_PREFIX)))
+                .limit(max(self.args.requests * 10, 1000))
+            ]
+        random.shuffle(self.seeded)
+        for pin_hash in self.seeded:
+            self.daemon.pins[pin_hash] = "recursive"
+            self.daemon.sizes[pin_hash] = self.args.size
+
+    # scenarios, each making one request
+
+    def pin_list(self, _: int) -> requests.Response:
+        """ get a random page of pins """
+        return self._call(
+            "GET",
+            "data/pinList",
+            params={
+                "pageLimit": self.args.page_limit,
+                "pageOffset": random.randrange(max(self.args.pins, 1)),
+            },
+        )
+
+    def pin_list_ndjson(self, _: int) -> requests.Response:
+        """ stream every pin """
+        return self._call(
+            "GET", "data/pinList", headers={"Accept": "application/x-ndjson"}
+        )
+
+    def pin_list_etag(self, _: int) -> requests.Response:
+        """ poll the pins when they have not changed """
+        r = self._call("GET", "data/pinList")
+        return self._call(
+            "GET", "data/pinList", headers={"If-None-Match": r.headers["ETag"]}
+        )
+
+    def pin_list_full_page(self, _: int) -> requests.Response:
+        """ get the first page of pins, which costs the same queries at any size """
+        return self._call(
+            "GET", "data/pinList", params={"pageLimit": self.args.page_limit}
+        )
+
+    def pin_list_keyvalues(self, _: int) -> requests.Response:
+        """ find the pins with a random source, using the key and value index """
+        return self._call(
+            "GET",
+            "data/pinList",
+            params={
+                "pageLimit": self.args.page_limit,
+                "metadata[keyvalues]": json.dumps(
+                    {"source": {"value": "bench-{}".format(random.randrange(1000))}}
+                ),
+            },
+        )
+
+    def pin_list_hash_contains(self, _: int) -> requests.Response:
+        """ find the pins containing part of a random hash, using the trigram index """
+        pin_hash = self._random_hash()
+        offset = random.randrange(len(pin_hash) - 8)
+        return self._call(
+            "GET",
+            "data/pinList",
+            params={"hashContains": pin_hash[offset : offset + 8]},
+        )
+
+    def user_pinned_data_total(self, _: int) -> requests.Response:
+        """ get the usage of the admin user """
+        return self._call("GET", "data/userPinnedDataTotal")
+
+    def pin_jobs(self, _: int) -> requests.Response:
+        """ list the pin jobs """
+        return self._call("GET", "pinJobs")
+
+    def hash_metadata(self, i: int) -> requests.Response:
+        """ set a key on a random pin """
+        return self.client.md(self._random_hash(), {"bench": str(i)})
+
+    def hash_metadata_batch(self, i: int) -> requests.Response:
+        """ set a key on a batch of random pins """
+        r = self._call(
+            "PUT",
+            "pinning/hashMetadataBatch",
+            json={
+                "items": [
+                    {"ipfsPinHash": self._random_hash(), "keyvalues": {"bench": str(i)}}
+                    for _ in range(self.args.batch_size)
+                ]
+            },
+        )
+        r.raise_for_status()
+        return r
+
+    def pin_by_hash(self, _: int) -> requests.Response:
+        """ queue a pin of a new hash """
+        return self.client.add(_fake_hash(os.urandom(32)), name="bench.cab")
+
+    def pin_by_hash_batch(self, _: int) -> requests.Response:
+        """ queue pins of a batch of new hashes """
+        r = self._call(
+            "POST",
+            "pinning/pinByHashBatch",
+            json={
+                "pins": [
+                    {"hashToPin": _fake_hash(os.urandom(32))}
+                    for _ in range(self.args.batch_size)
+                ]
+            },
+        )
+        r.raise_for_status()
+        return r
+
+    def pin_file_to_ipfs(self, _: int) -> requests.Response:
+        """ upload a new file """
+        boundary = os.urandom(16).hex()
+        self._count(self.args.size)
+        return self._call(
+            "POST",
+            "pinning/pinFileToIPFS",
+            data=_multipart_file(self.args.size, boundary),
+            headers={"Content-Type": "multipart/form-data; boundary=" + boundary},
+        )
+
+    def pin_json_to_ipfs(self, i: int) -> requests.Response:
+        """ add some new JSON """
+        return self._call(
+            "POST",
+            "pinning/pinJSONToIPFS",
+            json={"pinataContent": {"bench": i, "nonce": os.urandom(8).hex()}},
+        )
+
+    def gateway(self, _: int) -> requests.Response:
+        """ download a random pin """
+        return self._call("GET", "ipfs/{}".format(self._random_hash()))
+
+    def unpin(self, _: int) -> requests.Response:
+        """ unpin a pin, which is then gone for the next scenarios """
+        return self.client.rm(self._pop_hash())
+
+    def unpin_batch(self, _: int) -> requests.Response:
+        """ unpin a batch of pins """
+        r = self._call(
+            "POST",
+            "pinning/unpinBatch",
+            json={"hashes": [self._pop_hash() for _ in range(self.args.batch_size)]},
+        )
+        r.raise_for_status()
+        return r
+
+    def publish_by_hash(self, _: int) -> requests.Response:
+        """ queue publishing a random pin """
+        return self.client.pub(self._random_hash())
+
+    def api_key_lookup(self, _: int) -> requests.Response:
+        """ authenticate with a random key from the database """
+        i = random.randrange(SEED_API_KEYS)
+        return self._call(
+            "GET",
+            "data/userPinnedDataTotal",
+            headers={
+                "pinata_api_key": "bench-{}".format(i),
+                "pinata_secret_api_key": "bench-secret-{}".format(i),
+            },
+        )
+
+    def api_key_unknown(self, _: int) -> requests.Response:
+        """ authenticate with a key that does not exist """
+        return self._call(
+            "GET",
+            "data/userPinnedDataTotal",
+            headers={
+                "pinata_api_key": os.urandom(10).hex(),
+                "pinata_secret_api_key": "bench",
+            },
+        )
+
+    def _auth(self, api_key: str, secret: str) -> requests.Response:
+        """ authenticate in-process, without the HTTP request around it """
+        r = requests.Response()
+        with app.app_context():
+            info = lookup_api_key(api_key)
+            r.status_code = 200 if info and check_secret(info, secret) else 401
+        return r
+
+    def auth_cached(self, _: int) -> requests.Response:
+        """ look up and check a random seeded key, which is usually cached """
+        i = random.randrange(SEED_API_KEYS)
+        return self._auth("bench-{}".format(i), "bench-secret-{}".format(i))
+
+    def auth_uncached(self, _: int) -> requests.Response:
+        """ look up and check a random seeded key after removing it from the cache """
+        i = random.randrange(SEED_API_KEYS)
+        invalidate_api_key("bench-{}".format(i))
+        return self._auth("bench-{}".format(i), "bench-secret-{}".format(i))
+
+    def auth_unknown(self, _: int) -> requests.Response:
+        """ look up a key that does not exist """
+        return self._auth(os.urandom(10).hex(), "bench")
+
+    def pin_json_to_ipfs_duplicate(self, _: int) -> requests.Response:
+        """ add the same JSON, which is found from its digest """
+        return self._call(
+            "POST",
+            "pinning/pinJSONToIPFS",
+            json={"pinataContent": {"bench": "duplicate"}},
+        )
+
+    def generate_api_key(self, i: int) -> requests.Response:
+        """ make a new API key """
+        return self._call(
+            "POST", "users/generateApiKey", json={"keyName": "bench-{}".format(i)}
+        )
+
+    def run(
+        self, name: str, func: Callable[[int], requests.Response]
+    ) -> Dict[str, Any]:
+        """ send the requests at the configured concurrency and summarize """
+        latencies: List[float] = []
+        failed = 0
+
+        def _request(i: int) -> Tuple[float, int]:
+            start = time.perf_counter()
+            try:
+                r = func(i)
+            except requests.RequestException as e:
+                print("{}: {}".format(name, str(e)), file=sys.stderr)
+                return time.perf_counter() - start, 599
+            return time.perf_counter() - start, r.status_code
+
+        queries = _metric_total("stomata_request_db_queries_sum")
+        ipfs_calls = _metric_total("stomata_ipfs_call_duration_seconds_count")
+        expected_status = EXPECTED_STATUS.get(name, [200, 304])
+        self.transferred = 0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            for duration, status in executor.map(_request, range(self.args.requests)):
+                latencies.append(duration)
+                if status not in expected_status:
+                    failed += 1
+        elapsed = time.perf_counter() - start
+        queries = _metric_total("stomata_request_db_queries_sum") - queries
+        ipfs_calls = (
+            _metric_total("stomata_ipfs_call_duration_seconds_count") - ipfs_calls
+        )
+        latencies.sort()
+        count = len(latencies) or 1
+        return {
+            "scenario": name,
+            "requests": len(latencies),
+            "failed": failed,
+            "p50_ms": _percentile(latencies, 50) * 1000,
+            "p99_ms": _percentile(latencies, 99) * 1000,
+            "requests_per_s": len(latencies) / elapsed,
+            "mib_per_s": self.transferred / elapsed / (1 << 20),
+            "queries_per_request": queries / count,
+            "ipfs_calls_per_request": ipfs_calls / count,
+            "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+
+
+SCENARIOS = {
+    "pinList": "pin_list",
+    "pinListFullPage": "pin_list_full_page",
+    "pinListKeyvalues": "pin_list_keyvalues",
+    "pinListHashContains": "pin_list_hash_contains",
+    "pinListNdjson": "pin_list_ndjson",
+    "pinListEtag": "pin_list_etag",
+    "userPinnedDataTotal": "user_pinned_data_total",
+    "apiKeyLookup": "api_key_lookup",
+    "apiKeyUnknown": "api_key_unknown",
+    "authCached": "auth_cached",
+    "authUncached": "auth_uncached",
+    "authUnknown": "auth_unknown",
+    "pinJobs": "pin_jobs",
+    "hashMetadata": "hash_metadata",
+    "hashMetadataBatch": "hash_metadata_batch",
+    "pinByHash": "pin_by_hash",
+    "pinByHashBatch": "pin_by_hash_batch",
+    "pinFileToIPFS": "pin_file_to_ipfs",
+    "pinJSONToIPFS": "pin_json_to_ipfs",
+    "pinJSONToIPFSDuplicate": "pin_json_to_ipfs_duplicate",
+    "gateway": "gateway",
+    "publishByHash": "publish_by_hash",
+    "generateApiKey": "generate_api_key",
+    "unpin": "unpin",
+    "unpinBatch": "unpin_batch",
+}
+
+# scenarios where other responses are expected
+EXPECTED_STATUS = {"apiKeyUnknown": [401], "authUnknown": [401]}
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the routes against a fake IPFS daemon"
+    )
+    parser.add_argument(
+        "--database",
+        default="sqlite:///stomata-bench.db",
+        help="Throwaway database to use; the routes that write use "
+        "PostgreSQL upserts, so use e.g. postgresql:///stomata_bench for those",
+    )
+    parser.add_argument(
+        "--pins",
+        type=int,
+        default=10000,
+        help="Number of pins to add to the database before running",
+    )
+    parser.add_argument(
+        "--requests", type=int, default=1000, help="Number of requests per scenario"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="Number of requests at a time"
+    )
+    parser.add_argument(
+        "--ipfs-latency",
+        type=float,
+        default=1,
+        help="Time taken by the fake daemon to answer, in milliseconds",
+    )
+    parser.add_argument(
+        "--size",
+        type=_parse_size,
+        default="1K",
+        help="Size of each uploaded or downloaded file, e.g. 1K, 10M or 4G",
+    )
+    parser.add_argument(
+        "--page-limit", type=int, default=1000, help="Rows in each pinList page"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=100, help="Items in each batch request"
+    )
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        help="Scenarios to run, by default all of them: {}".format(
+            ", ".join(SCENARIOS)
+        ),
+    )
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            print("unknown scenario {}".format(name))
+            sys.exit(1)
+    if args.database == app.config["SQLALCHEMY_DATABASE_URI"]:
+        print("refusing to use the configured database, which may be live data")
+        sys.exit(1)
+
+    # the fake daemon
+    daemon = FakeIpfsDaemon(args.ipfs_latency / 1000)
+    ipfs_server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeIpfsHandler)
+    ipfs_server.daemon = daemon  # type: ignore
+    ipfs_server.daemon_threads = True
+    ipfs_port = _serve(ipfs_server)
+
+    # the app
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    app.logger.setLevel(logging.WARNING)
+    app.config["DEBUG"] = False
+    app.config["SQLALCHEMY_DATABASE_URI"] = args.database
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {}
+    app.config["IPFS_API_ADDR"] = "/ip4/127.0.0.1/tcp/{}/http".format(ipfs_port)
+    app.config["IPFS_POOL_SIZE"] = max(args.concurrency, 8)
+    app_server = make_server(
+        "127.0.0.1", 0, app, threaded=True, request_handler=_KeepAliveHandler
+    )
+    app_port = _serve(app_server)
+
+    bench = Benchmark(args, "http://127.0.0.1:{}/".format(app_port), daemon)
+    bench.seed(args.pins)
+    results = []
+    for name in args.scenarios or SCENARIOS:
+        results.append(bench.run(name, getattr(bench, SCENARIOS[name])))
+        if not args.json:
+            print(
+                "{scenario:20} {requests:6} req {failed:4} failed "
+                "p50 {p50_ms:8.2f}ms p99 {p99_ms:8.2f}ms "
+                "{requests_per_s:8.1f} req/s {mib_per_s:8.2f} MiB/s "
+                "{queries_per_request:6.1f} queries/req "
+                "{ipfs_calls_per_request:4.1f} ipfs/req "
+                "peak RSS {peak_rss_mib:.0f}MiB".format(**results[-1])
+            )
+    if args.json:
+        print(json.dumps(results, indent=2))
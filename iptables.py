@@ -5,33 +5,54 @@
 #
 # SPDX-License-Identifier: GPL-2.0+
 #
-# pylint: disable=invalid-name,singleton-comparison,no-member,unsubscriptable-object,too-few-public-methods
+# pylint: disable=invalid-name,singleton-comparison,no-member,unsubscriptable-object,too-few-public-methods,redefined-outer-name
 
-""" block countries using iptables """
+"""Block countries using a single nftables or ipset set.
 
+All the netblocks are written to one ruleset file which is loaded in a single
+transaction, so the old set is replaced atomically and incoming packets are
+matched with one set lookup rather than one rule per netblock.
+"""
+
+import os
 import sys
-import gzip
-import csv
-import math
+import argparse
 import subprocess
 from collections import defaultdict
-
-from io import StringIO
+from typing import Dict, List, Set, Tuple
 
 from stomata import app
+from stomata.geoip import read_geoip_csv
+
+NFT_TABLE = "stomata"
+IPSET_NAME = "stomata-banned"
 
 
 class Netblock:
     """ a range of addresses """
 
-    def __init__(self, addr_from, addr_to):
+    def __init__(self, addr_from: int, addr_to: int) -> None:
         self.addr_from = addr_from
         self.addr_to = addr_to
 
     @property
-    def subnet(self) -> int:
-        """ return the subnet defining the start to the end """
-        return int(math.log(self.addr_to - self.addr_from + 1, 2))
+    def cidrs(self) -> List[Tuple[int, int]]:
+        """ return the fewest (address, prefix length) pairs covering the range """
+        cidrs: List[Tuple[int, int]] = []
+        addr = self.addr_from
+        while addr <= self.addr_to:
+            # the largest block aligned at addr that does not go past the end
+            size = addr & -addr if addr else 1 << 32
+            while addr + size - 1 > self.addr_to:
+                size >>= 1
+            cidrs.append((addr, 33 - size.bit_length()))
+            addr += size
+        return cidrs
+
+    def __str__(self) -> str:
+        return "{}-{}".format(
+            _value_to_ip_addr(self.addr_from), _value_to_ip_addr(self.addr_to)
+        )
 
 
 def _value_to_ip_addr(val: int) -> str:
@@ -40,35 +61,155 @@ def _value_to_ip_addr(val: int) -> str:
     )
 
 
+def _read_netblocks(filename: str) -> Dict[str, List[Netblock]]:
+    """ read the netblocks of each banned country """
+    netblocks: Dict[str, List[Netblock]] = defaultdict(list)
+    for addr_from, addr_to, country_code in read_geoip_csv(filename):
+        if country_code in app.config["BANNED_COUNTRY_CODES"]:
+            netblocks[country_code].append(Netblock(addr_from, addr_to))
+    return netblocks
+
+
+def _merge_netblocks(netblocks: List[Netblock]) -> List[Netblock]:
+    """ sort netblocks and merge any that overlap or are adjacent """
+    merged: List[Netblock] = []
+    for block in sorted(netblocks, key=lambda block: block.addr_from):
+        if merged and block.addr_from <= merged[-1].addr_to + 1:
+            merged[-1].addr_to = max(merged[-1].addr_to, block.addr_to)
+            continue
+        merged.append(Netblock(block.addr_from, block.addr_to))
+    return merged
+
+
+def _nft_ruleset(netblocks: List[Netblock]) -> str:
+    """ get an nftables ruleset that replaces the table in one transaction """
+    lines = [
+        # create the table if it does not exist so that it can be deleted
+        "table inet {}".format(NFT_TABLE),
+        "delete table inet {}".format(NFT_TABLE),
+        "table inet {} {{".format(NFT_TABLE),
+        "    set banned_ipv4 {",
+        "        type ipv4_addr",
+        "        flags interval",
+    ]
+    if netblocks:
+        lines.append("        elements = {")
+        lines.extend("            {},".format(block) for block in netblocks)
+        lines.append("        }")
+    lines.extend(
+        [
+            "    }",
+            "    chain input {",
+            "        type filter hook input priority -1; policy accept;",
+            "        ip saddr @banned_ipv4 drop",
+            "    }",
+            "}",
+        ]
+    )
+    return "\n".join(lines) + "\n"
+
+
+def _ipset_names() -> Set[str]:
+    """ get the names of the existing ipset sets """
+    try:
+        p = subprocess.run(["ipset", "list", "-name"], check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError) as _:
+        return set()
+    return set(p.stdout.decode("utf-8", "ignore").split())
+
+
+def _ipset_restore(netblocks: List[Netblock], existing: Set[str]) -> str:
+    """Get an ipset restore script that swaps in a new set.
+
+    The hash:net set stores prefixes, so the ranges are written as CIDRs.
+    The new set is always created from scratch, as ``create -exist`` fails if
+    the existing set has a different maxelem, and the sets can be swapped
+    whatever their maxelem.
+    """
+    create = "create {} hash:net family inet maxelem {}"
+    cidrs = [cidr for block in netblocks for cidr in block.cidrs]
+    maxelem = max(65536, len(cidrs))
+    lines = []
+    if IPSET_NAME + "-new" in existing:
+        lines.append("destroy {}-new".format(IPSET_NAME))
+    lines.append(create.format(IPSET_NAME + "-new", maxelem))
+    lines.extend(
+        "add {}-new {}/{}".format(IPSET_NAME, _value_to_ip_addr(addr), prefix)
+        for addr, prefix in cidrs
+    )
+    if IPSET_NAME in existing:
+        lines.extend(
+            [
+                "swap {0}-new {0}".format(IPSET_NAME),
+                "destroy {}-new".format(IPSET_NAME),
+            ]
+        )
+    else:
+        lines.append("rename {0}-new {0}".format(IPSET_NAME))
+    return "\n".join(lines) + "\n"
+
+
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input",
+        default="geoipdata.csv.gz",
+        help="Compressed GeoIP CSV file",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["nft", "ipset"],
+        default="nft",
+        help="Firewall to load the set into; an ipset set has to be matched "
+        "by an existing rule, e.g. "
+        "'iptables -I INPUT -m set --match-set {} src -j DROP'".format(IPSET_NAME),
+    )
+    parser.add_argument(
+        "--output",
+        help="Ruleset file to write, by default stomata-banned.nft or .ipset",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only write the ruleset file, do not load it",
+    )
+    args = parser.parse_args()
+
     # read the list of netblocks
-    with gzip.open("geoipdata.csv.gz", "rb") as f:
-        blob = f.read()
-    netblocks = defaultdict(list)
-    for row in csv.reader(StringIO(blob.decode("utf-8", "ignore"))):
-        try:
-            country_code = row[4]
-            if country_code not in app.config["BANNED_COUNTRY_CODES"]:
-                continue
-            netblocks[country_code].append(Netblock(int(row[0]), int(row[1])))
-        except IndexError as _:
-            pass
-
-    # block each IP range
-    for country_code in netblocks:
-        print("Blocking country code {}".format(country_code))
-        for block in netblocks[country_code]:
-            argv = [
-                "firewall-cmd",
-                "--zone=external",
-                "--permanent",
-                '--add-rich-rule=rule family="ipv4" source address="{}/{}" drop'.format(
-                    _value_to_ip_addr(block.addr_from), block.subnet
-                ),
-            ]
-            try:
-                subprocess.run(argv, check=True, capture_output=True)
-            except subprocess.CalledProcessError as e:
-                print(str(e))
-                sys.exit(1)
+    netblocks_for_country = _read_netblocks(args.input)
+    netblocks: List[Netblock] = []
+    for country_code in sorted(netblocks_for_country):
+        print(
+            "Blocking country code {}: {} netblocks".format(
+                country_code, len(netblocks_for_country[country_code])
+            )
+        )
+        netblocks.extend(netblocks_for_country[country_code])
+    netblocks = _merge_netblocks(netblocks)
+
+    # write the ruleset, replacing any previous file atomically
+    if args.backend == "nft":
+        ruleset = _nft_ruleset(netblocks)
+        argv = ["nft", "-f"]
+    else:
+        ruleset = _ipset_restore(netblocks, set() if args.dry_run else _ipset_names())
+        argv = ["ipset", "restore", "-file"]
+    filename = args.output or "{}.{}".format(IPSET_NAME, args.backend)
+    with open(filename + ".tmp", "w", encoding="utf-8") as f:
+        f.write(ruleset)
+    os.replace(filename + ".tmp", filename)
+    print(
+        "Wrote {} ranges, {} prefixes, to {}".format(
+            len(netblocks), sum(len(block.cidrs) for block in netblocks), filename
+        )
+    )
+    if args.dry_run:
+        sys.exit(0)
+
+    # load everything in one transaction
+    try:
+        subprocess.run(argv + [filename], check=True, capture_output=True)
+    except subprocess.CalledProcessError as e:
+        print(str(e), e.stderr.decode("utf-8", "ignore"))
+        sys.exit(1)
@@ -0,0 +1,29 @@
+"""Add the digests of pinned JSON content
+
+Revision ID: 0b6e92d4f3a1
+Revises: f4a7c3d91b58
+Create Date: 2026-10-17 17:10:44.527391
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "0b6e92d4f3a1"
+down_revision = "f4a7c3d91b58"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "json_digests",
+        sa.Column("digest", sa.String(), nullable=False),
+        sa.Column("pin_hash", sa.String(), nullable=False),
+        sa.Column("date_created", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("digest"),
+    )
+
+
+def downgrade():
+    op.drop_table("json_digests")
@@ -0,0 +1,76 @@
+"""Add lookup indexes and a unique constraint on the pin hash
+
+Revision ID: 2c1f6a9e4b3d
+Revises:
+Create Date: 2026-10-17 09:12:41.192634
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "2c1f6a9e4b3d"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keep the newest row for each duplicated hash, moving over any attributes
+    # the newest row does not have, so that the unique index can be created
+    op.execute(
+        """
+        CREATE TEMPORARY TABLE ipfs_dups AS
+        SELECT ipfs_id, keep_id FROM (
+            SELECT ipfs_id, first_value(ipfs_id) OVER (
+                PARTITION BY pin_hash ORDER BY date_pinned DESC, ipfs_id DESC
+            ) AS keep_id FROM ipfs
+        ) AS ranked WHERE ipfs_id != keep_id
+        """
+    )
+    op.execute(
+        """
+        DELETE FROM ipfs_attr a USING ipfs_dups d, ipfs_attr k
+        WHERE a.ipfs_id = d.ipfs_id AND k.ipfs_id = d.keep_id AND k.key = a.key
+        """
+    )
+    op.execute(
+        """
+        UPDATE ipfs_attr a SET ipfs_id = d.keep_id
+        FROM ipfs_dups d WHERE a.ipfs_id = d.ipfs_id
+        """
+    )
+    op.execute("DELETE FROM ipfs i USING ipfs_dups d WHERE i.ipfs_id = d.ipfs_id")
+    op.execute("DROP TABLE ipfs_dups")
+
+    # keep the newest value for each duplicated attribute
+    op.execute(
+        """
+        DELETE FROM ipfs_attr a USING ipfs_attr b
+        WHERE a.ipfs_id = b.ipfs_id AND a.key = b.key
+        AND a.ipfs_attribute_id < b.ipfs_attribute_id
+        """
+    )
+
+    op.create_index(op.f("ix_ipfs_pin_hash"), "ipfs", ["pin_hash"], unique=True)
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.create_index(
+        "ix_ipfs_pin_hash_trgm",
+        "ipfs",
+        ["pin_hash"],
+        unique=False,
+        postgresql_using="gin",
+        postgresql_ops={"pin_hash": "gin_trgm_ops"},
+    )
+    op.create_unique_constraint(
+        "uq_ipfs_attr_ipfs_id_key", "ipfs_attr", ["ipfs_id", "key"]
+    )
+    op.create_index(
+        "ix_ipfs_attr_key_value", "ipfs_attr", ["key", "value"], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index("ix_ipfs_attr_key_value", table_name="ipfs_attr")
+    op.drop_constraint("uq_ipfs_attr_ipfs_id_key", "ipfs_attr", type_="unique")
+    op.drop_index("ix_ipfs_pin_hash_trgm", table_name="ipfs")
+    op.drop_index(op.f("ix_ipfs_pin_hash"), table_name="ipfs")
@@ -0,0 +1,53 @@
+"""Make unknown object sizes NULL so the worker resolves them
+
+Revision ID: 3f0c7d2a9e85
+Revises: 8e3a5b7c1d04
+Create Date: 2026-10-17 21:48:37.105264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "3f0c7d2a9e85"
+down_revision = "8e3a5b7c1d04"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # changing the type rewrites the table, which is locked until it is done
+    op.alter_column(
+        "ipfs",
+        "size",
+        type_=sa.BigInteger(),
+        existing_type=sa.Integer(),
+        existing_nullable=True,
+    )
+    op.execute("UPDATE ipfs SET size = NULL WHERE size = 0 AND date_unpinned IS NULL")
+
+    # build the index without blocking writes, which cannot be in a transaction
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_ipfs_size_pending",
+            "ipfs",
+            ["ipfs_id"],
+            unique=False,
+            postgresql_where=sa.text("size IS NULL AND date_unpinned IS NULL"),
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_ipfs_size_pending", table_name="ipfs", postgresql_concurrently=True
+        )
+    op.execute("UPDATE ipfs SET size = 0 WHERE size IS NULL")
+    op.alter_column(
+        "ipfs",
+        "size",
+        type_=sa.Integer(),
+        existing_type=sa.BigInteger(),
+        existing_nullable=True,
+    )
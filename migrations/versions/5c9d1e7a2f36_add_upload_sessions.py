@@ -0,0 +1,67 @@
+"""Add resumable upload sessions
+
+Revision ID: 5c9d1e7a2f36
+Revises: 0b6e92d4f3a1
+Create Date: 2026-10-17 17:52:19.604835
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "5c9d1e7a2f36"
+down_revision = "0b6e92d4f3a1"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "upload_sessions",
+        sa.Column("upload_session_id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.String(), nullable=False),
+        sa.Column("name", sa.String(), nullable=True),
+        sa.Column("md", sa.Text(), nullable=True),
+        sa.Column("size", sa.BigInteger(), nullable=False),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("date_created", sa.DateTime(), nullable=False),
+        sa.Column("date_updated", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("upload_session_id"),
+    )
+    op.create_index(
+        op.f("ix_upload_sessions_date_updated"),
+        "upload_sessions",
+        ["date_updated"],
+        unique=False,
+    )
+    op.create_table(
+        "upload_chunks",
+        sa.Column("upload_chunk_id", sa.Integer(), nullable=False),
+        sa.Column("upload_session_id", sa.Integer(), nullable=False),
+        sa.Column("offset", sa.BigInteger(), nullable=False),
+        sa.Column("length", sa.BigInteger(), nullable=False),
+        sa.Column("checksum", sa.String(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["upload_session_id"],
+            ["upload_sessions.upload_session_id"],
+        ),
+        sa.PrimaryKeyConstraint("upload_chunk_id"),
+        sa.UniqueConstraint(
+            "upload_session_id", "offset", name="uq_upload_chunks_session_offset"
+        ),
+    )
+    op.create_index(
+        op.f("ix_upload_chunks_upload_session_id"),
+        "upload_chunks",
+        ["upload_session_id"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index(
+        op.f("ix_upload_chunks_upload_session_id"), table_name="upload_chunks"
+    )
+    op.drop_table("upload_chunks")
+    op.drop_index(op.f("ix_upload_sessions_date_updated"), table_name="upload_sessions")
+    op.drop_table("upload_sessions")
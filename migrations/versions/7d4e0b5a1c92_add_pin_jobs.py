@@ -0,0 +1,43 @@
+"""Add the queue of pin jobs
+
+Revision ID: 7d4e0b5a1c92
+Revises: 2c1f6a9e4b3d
+Create Date: 2026-10-17 10:41:03.517326
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "7d4e0b5a1c92"
+down_revision = "2c1f6a9e4b3d"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "pin_jobs",
+        sa.Column("pin_job_id", sa.Integer(), nullable=False),
+        sa.Column("pin_hash", sa.String(), nullable=False),
+        sa.Column("name", sa.String(), nullable=True),
+        sa.Column("md", sa.Text(), nullable=True),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.Column("error", sa.Text(), nullable=True),
+        sa.Column("date_queued", sa.DateTime(), nullable=False),
+        sa.Column("date_next_attempt", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("pin_job_id"),
+        sa.UniqueConstraint("pin_hash"),
+    )
+    op.create_index(
+        op.f("ix_pin_jobs_date_next_attempt"),
+        "pin_jobs",
+        ["date_next_attempt"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_pin_jobs_date_next_attempt"), table_name="pin_jobs")
+    op.drop_table("pin_jobs")
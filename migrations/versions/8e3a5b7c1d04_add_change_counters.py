@@ -0,0 +1,29 @@
+"""Add the change counters used for ETags
+
+Revision ID: 8e3a5b7c1d04
+Revises: 5c9d1e7a2f36
+Create Date: 2026-10-17 19:04:12.381946
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "8e3a5b7c1d04"
+down_revision = "5c9d1e7a2f36"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    change_counters = op.create_table(
+        "change_counters",
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("value", sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint("name"),
+    )
+    op.bulk_insert(change_counters, [{"name": "pins", "value": 0}])
+
+
+def downgrade():
+    op.drop_table("change_counters")
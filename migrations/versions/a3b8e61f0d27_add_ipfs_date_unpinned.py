@@ -0,0 +1,23 @@
+"""Add the date an object was found to be unpinned
+
+Revision ID: a3b8e61f0d27
+Revises: 7d4e0b5a1c92
+Create Date: 2026-10-17 12:03:55.021873
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "a3b8e61f0d27"
+down_revision = "7d4e0b5a1c92"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("ipfs", sa.Column("date_unpinned", sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("ipfs", "date_unpinned")
@@ -0,0 +1,47 @@
+"""Add the queue of IPNS publishes
+
+Revision ID: c5f2d8e94a10
+Revises: a3b8e61f0d27
+Create Date: 2026-10-17 14:26:12.804417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "c5f2d8e94a10"
+down_revision = "a3b8e61f0d27"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "ipns_publishes",
+        sa.Column("ipns_publish_id", sa.Integer(), nullable=False),
+        sa.Column("key", sa.String(), nullable=False),
+        sa.Column("pin_hash", sa.String(), nullable=False),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.Column("error", sa.Text(), nullable=True),
+        sa.Column("ipns_hash", sa.String(), nullable=True),
+        sa.Column("published_hash", sa.String(), nullable=True),
+        sa.Column("date_queued", sa.DateTime(), nullable=False),
+        sa.Column("date_next_attempt", sa.DateTime(), nullable=False),
+        sa.Column("date_published", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("ipns_publish_id"),
+        sa.UniqueConstraint("key"),
+    )
+    op.create_index(
+        op.f("ix_ipns_publishes_date_next_attempt"),
+        "ipns_publishes",
+        ["date_next_attempt"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index(
+        op.f("ix_ipns_publishes_date_next_attempt"), table_name="ipns_publishes"
+    )
+    op.drop_table("ipns_publishes")
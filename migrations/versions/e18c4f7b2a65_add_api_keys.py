@@ -0,0 +1,34 @@
+"""Add API keys
+
+Revision ID: e18c4f7b2a65
+Revises: c5f2d8e94a10
+Create Date: 2026-10-17 15:48:30.663120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "e18c4f7b2a65"
+down_revision = "c5f2d8e94a10"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "api_keys",
+        sa.Column("api_key_id", sa.Integer(), nullable=False),
+        sa.Column("api_key", sa.String(), nullable=False),
+        sa.Column("secret_hash", sa.String(), nullable=False),
+        sa.Column("name", sa.String(), nullable=True),
+        sa.Column("admin", sa.Boolean(), nullable=False),
+        sa.Column("date_created", sa.DateTime(), nullable=False),
+        sa.Column("date_revoked", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("api_key_id"),
+        sa.UniqueConstraint("api_key"),
+    )
+
+
+def downgrade():
+    op.drop_table("api_keys")
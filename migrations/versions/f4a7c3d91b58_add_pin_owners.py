@@ -0,0 +1,47 @@
+"""Add the owner of each pin and the per-user usage counters
+
+Revision ID: f4a7c3d91b58
+Revises: e18c4f7b2a65
+Create Date: 2026-10-17 16:32:07.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from flask import current_app
+
+# revision identifiers, used by Alembic.
+revision = "f4a7c3d91b58"
+down_revision = "e18c4f7b2a65"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # everything pinned so far was pinned by the admin
+    admin_email = current_app.config["ADMIN_EMAIL"]
+    for table in ["ipfs", "pin_jobs", "api_keys"]:
+        op.add_column(table, sa.Column("user_id", sa.String(), nullable=True))
+        op.execute(
+            sa.table(table, sa.column("user_id")).update().values(user_id=admin_email)
+        )
+        op.alter_column(table, "user_id", nullable=False)
+    op.create_index(op.f("ix_ipfs_user_id"), "ipfs", ["user_id"], unique=False)
+    op.create_table(
+        "user_usage",
+        sa.Column("user_id", sa.String(), nullable=False),
+        sa.Column("pin_count", sa.Integer(), nullable=False),
+        sa.Column("pin_size", sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint("user_id"),
+    )
+    op.execute(
+        "INSERT INTO user_usage (user_id, pin_count, pin_size) "
+        "SELECT user_id, count(*), coalesce(sum(size), 0) FROM ipfs "
+        "WHERE date_unpinned IS NULL GROUP BY user_id"
+    )
+
+
+def downgrade():
+    op.drop_table("user_usage")
+    op.drop_index(op.f("ix_ipfs_user_id"), table_name="ipfs")
+    for table in ["ipfs", "pin_jobs", "api_keys"]:
+        op.drop_column(table, "user_id")
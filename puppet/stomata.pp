@@ -98,6 +98,9 @@ bind = '127.0.0.1:5000'
 loglevel = 'info'
 accesslog = '-'
 x_forwarded_for_header = True
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
 ",
     require => Vcsrepo['/var/www/stomata'],
 }
@@ -113,6 +116,9 @@ Type=simple
 User=nginx
 Group=nginx
 WorkingDirectory=/var/www/stomata
+RuntimeDirectory=stomata-metrics
+RuntimeDirectoryPreserve=yes
+Environment=PROMETHEUS_MULTIPROC_DIR=/run/stomata-metrics
 ExecStart=/bin/sh -c './env/bin/gunicorn --config gunicorn.py stomata:app'
 [Install]
 WantedBy=multi-user.target
@@ -126,6 +132,36 @@ service { 'gunicorn':
     require => File['/etc/systemd/system/gunicorn.service'],
 }
 
+file { '/etc/systemd/system/stomata-worker.service':
+    ensure => "file",
+    content => "# Managed by Puppet, DO NOT EDIT
+[Unit]
+Description=stomata-worker
+After=network.target ipfsdaemon.service
+[Service]
+Type=simple
+User=nginx
+Group=nginx
+WorkingDirectory=/var/www/stomata
+RuntimeDirectory=stomata-metrics
+RuntimeDirectoryPreserve=yes
+Environment=FLASK_APP=stomata
+Environment=PROMETHEUS_MULTIPROC_DIR=/run/stomata-metrics
+ExecStart=/bin/sh -c './env/bin/flask worker'
+ExecStopPost=/bin/sh -c 'rm -f /run/stomata-metrics/gauge_live*_\$MAINPID.db'
+Restart=on-failure
+[Install]
+WantedBy=multi-user.target
+",
+    require => [ Exec['pip_requirements_install'] ],
+}
+
+service { 'stomata-worker':
+    ensure => 'running',
+    enable => true,
+    require => File['/etc/systemd/system/stomata-worker.service'],
+}
+
 file { '/etc/systemd/system/ipfsdaemon.service':
     ensure => "file",
     content => "# Managed by Puppet, DO NOT EDIT
@@ -13,23 +13,113 @@ Re-implementation of the Pinata API with support for publishing added.
 This is probably not a good idea to use in production.
 """
 
-from flask import Flask
+import tempfile
+from typing import IO, Any, Optional
+
+import click
+from flask import Flask, Request
 from flask_sqlalchemy import SQLAlchemy
+from flask_migrate import Migrate
+
+
+class StomataRequest(Request):
+    """ a request that spools uploaded files to disk above a fixed size """
+
+    def _get_file_stream(
+        self,
+        total_content_length: Optional[int],
+        content_type: Optional[str],
+        filename: Optional[str] = None,
+        content_length: Optional[int] = None,
+    ) -> IO[Any]:
+        return tempfile.SpooledTemporaryFile(
+            max_size=app.config.get("UPLOAD_BUFFER_SIZE", 0x100000)
+        )
+
 
 app = Flask(__name__)
+app.request_class = StomataRequest
 try:
     app.config.from_pyfile("custom.cfg")
 except FileNotFoundError as _:
     app.config.from_pyfile("stomata.cfg")
 db: SQLAlchemy = SQLAlchemy(app)
+migrate = Migrate(app, db)
 
 import stomata.routes
+import stomata.uploads
+import stomata.metrics
+import stomata.geoip
+
+
+def create_schema() -> None:
+    """ ensure all tables exist, along with the extensions the indexes need """
+    if db.engine.dialect.name == "postgresql":
+        db.engine.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    db.metadata.create_all(bind=db.engine)
 
 
 @app.cli.command("initdb")
 def initdb_command() -> None:
     """ ensure all tables exist """
-    db.metadata.create_all(bind=db.engine)
+    create_schema()
+
+
+@app.cli.command("worker")
+def worker_command() -> None:
+    """ process queued jobs """
+    from stomata.worker import run
+
+    run()
+
+
+@app.cli.command("reconcile")
+def reconcile_command() -> None:
+    """ reconcile the database with the pins on the IPFS daemon """
+    from stomata.worker import reconcile_pins
+
+    for key, value in reconcile_pins().items():
+        print("{}: {}".format(key, value))
+
+
+@app.cli.command("reconcile-usage")
+def reconcile_usage_command() -> None:
+    """ rebuild the per-user usage counters """
+    from stomata.worker import rebuild_usage
+
+    print("users: {}".format(rebuild_usage()))
+
+
+@app.cli.command("resolve-sizes")
+def resolve_sizes_command() -> None:
+    """ resolve every pending object size now """
+    from stomata.worker import resolve_sizes
+
+    resolved = 0
+    after_id = 0
+    while True:
+        count, after_id = resolve_sizes(after_id)
+        resolved += count
+        if not after_id:
+            break
+    print("resolved: {}".format(resolved))
+
+
+@app.cli.command("gc")
+def gc_command() -> None:
+    """ remove unpinned objects from the IPFS repo now """
+    from stomata.worker import collect_garbage
+
+    print("reclaimed: {}".format(collect_garbage()))
+
+
+@app.cli.command("geoip-compile")
+@click.argument("filename", default="geoipdata.csv.gz")
+def geoip_compile_command(filename: str) -> None:
+    """ compile the GeoIP CSV into GEOIP_INDEX, which servers then reload """
+    from stomata.geoip import compile_index
+
+    print("ranges: {}".format(compile_index(filename, app.config["GEOIP_INDEX"])))
 
 
 @app.cli.command("dropdb")
@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+#
+# pylint: disable=invalid-name,singleton-comparison,no-member,cyclic-import
+
+"""API key verification.
+
+Verified keys are cached in-process so that authenticating a request does not
+need a database round-trip. Revoking a key removes it from the cache of the
+worker handling the revoke; other workers notice within API_KEY_CACHE_TTL.
+
+Unknown keys are cached separately for a much shorter time, so that requests
+with random keys cannot evict the verified keys from the cache.
+"""
+
+import hmac
+import hashlib
+from typing import NamedTuple, Optional
+
+from stomata import app, db
+from .cache import LruCache
+from .models import ApiKey
+
+
+class ApiKeyInfo(NamedTuple):
+    """ the cached details of an API key """
+
+    api_key_id: Optional[int]
+    api_key: str
+    secret_hash: str
+    user_id: str
+    admin: bool
+
+
+_cache = LruCache(
+    max_size=app.config.get("API_KEY_CACHE_SIZE", 10000),
+    ttl=app.config.get("API_KEY_CACHE_TTL", 60),
+)
+_negative_cache = LruCache(
+    max_size=app.config.get("API_KEY_NEGATIVE_CACHE_SIZE", 1000),
+    ttl=app.config.get("API_KEY_NEGATIVE_CACHE_TTL", 5),
+)
+
+
+def hash_secret(secret: str) -> str:
+    """ hash a secret API key, which is random so does not need a salt """
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+
+def lookup_api_key(api_key: str) -> Optional[ApiKeyInfo]:
+    """Find an unrevoked API key, using the cache where possible.
+
+    The STOMATA_API_KEY and STOMATA_SECRET_API_KEY pair from the config is
+    always accepted as an admin key belonging to ADMIN_EMAIL.
+    """
+    if api_key == app.config["STOMATA_API_KEY"]:
+        return ApiKeyInfo(
+            None,
+            api_key,
+            hash_secret(app.config["STOMATA_SECRET_API_KEY"]),
+            app.config["ADMIN_EMAIL"],
+            admin=True,
+        )
+    info = _cache.get(api_key)
+    if info:
+        return info
+    if _negative_cache.get(api_key):
+        return None
+    key = (
+        db.session.query(ApiKey)
+        .filter(ApiKey.api_key == api_key)
+        .filter(ApiKey.date_revoked == None)
+        .first()
+    )
+    if not key:
+        _negative_cache.set(api_key, True)
+        return None
+    info = ApiKeyInfo(
+        key.api_key_id, key.api_key, key.secret_hash, key.user_id, key.admin
+    )
+    _cache.set(api_key, info)
+    return info
+
+
+def check_secret(info: ApiKeyInfo, secret: str) -> bool:
+    """ check the secret API key using a constant-time comparison """
+    return hmac.compare_digest(info.secret_hash, hash_secret(secret))
+
+
+def invalidate_api_key(api_key: str) -> None:
+    """ remove an API key from the cache """
+    _cache.pop(api_key)
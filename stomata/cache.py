@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+#
+# pylint: disable=invalid-name
+
+""" in-process caches """
+
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+
+class LruCache:
+    """A thread-safe least-recently-used cache with an optional expiry.
+
+    Entries older than ``ttl`` seconds are treated as missing, which bounds
+    how stale an entry can be when it is invalidated in another process.
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        """ get a cached value, or the default if missing or expired """
+        with self._lock:
+            try:
+                date_added, value = self._items[key]
+            except KeyError:
+                return default
+            if self.ttl is not None and time.monotonic() - date_added > self.ttl:
+                del self._items[key]
+                return default
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key: Any, value: Any) -> None:
+        """ add a value, evicting the least recently used if full """
+        with self._lock:
+            self._items[key] = (time.monotonic(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key: Any) -> None:
+        """ remove a value if it exists """
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self) -> None:
+        """ remove all values """
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self) -> int:
+        return len(self._items)
@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+#
+# pylint: disable=invalid-name,cyclic-import
+
+""" pooled connections to the IPFS daemon """
+
+import time
+import queue
+import threading
+from contextlib import ExitStack, contextmanager
+from typing import Any, Iterator, List, Optional, Tuple
+
+import ipfshttpclient
+
+from flask import g, has_request_context
+
+from stomata import app
+from .metrics import IPFS_LATENCY
+
+# errors where the connection itself is suspect, rather than the request
+_CONNECTION_ERRORS = (
+    ipfshttpclient.exceptions.ConnectionError,
+    ipfshttpclient.exceptions.TimeoutError,
+    ipfshttpclient.exceptions.ProtocolError,
+)
+
+
+class IpfsClientPool:
+    """A bounded pool of persistent IPFS HTTP clients.
+
+    Each client holds a keep-alive session to the daemon, so the version
+    negotiation and TCP connection are paid once per client rather than once
+    per request. Clients that have been idle for longer than the health check
+    interval are checked before being handed out again.
+    """
+
+    def __init__(
+        self,
+        addr: Any,
+        size: int,
+        timeout: float,
+        health_check_interval: float,
+        chunk_size: int,
+    ) -> None:
+        self.addr = addr
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.chunk_size = chunk_size
+        self._idle: "queue.LifoQueue[Tuple[Any, float]]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self) -> Any:
+        return ipfshttpclient.connect(
+            self.addr,
+            session=True,
+            chunk_size=self.chunk_size,
+            timeout=app.config.get("IPFS_TIMEOUT", 120),
+        )
+
+    @staticmethod
+    def close(client: Any) -> None:
+        """ close a client, ignoring any errors """
+        try:
+            client.close()
+        except ipfshttpclient.exceptions.Error as _:
+            pass
+
+    def _checkout(self) -> Any:
+        while True:
+            try:
+                client, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if time.monotonic() - last_used < self.health_check_interval:
+                return client
+            try:
+                client.version()
+                return client
+            except _CONNECTION_ERRORS as _:
+                self.close(client)
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        """ borrow a client from the pool, waiting if all are in use """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise ipfshttpclient.exceptions.TimeoutError(
+                "no IPFS client available after {}s".format(self.timeout)
+            )
+        try:
+            client = self._checkout()
+            broken = False
+            try:
+                yield client
+            except _CONNECTION_ERRORS:
+                broken = True
+                raise
+            finally:
+                if broken:
+                    self.close(client)
+                else:
+                    self._idle.put((client, time.monotonic()))
+        finally:
+            self._slots.release()
+
+
+_pool: Optional[IpfsClientPool] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> IpfsClientPool:
+    global _pool  # pylint: disable=global-statement
+    with _pool_lock:
+        if not _pool:
+            _pool = IpfsClientPool(
+                app.config.get("IPFS_API_ADDR", ipfshttpclient.DEFAULT_ADDR),
+                size=app.config.get("IPFS_POOL_SIZE", 8),
+                timeout=app.config.get("IPFS_POOL_TIMEOUT", 30),
+                health_check_interval=app.config.get("IPFS_HEALTH_CHECK_INTERVAL", 30),
+                chunk_size=app.config.get("UPLOAD_CHUNK_SIZE", 0x10000),
+            )
+        return _pool
+
+
+def _record_latency(operation: str, duration: float) -> None:
+    IPFS_LATENCY.labels(operation).observe(duration)
+    if has_request_context():
+        timings: List[Tuple[str, float]] = g.setdefault("ipfs_timings", [])
+        timings.append((operation, duration))
+
+
+@contextmanager
+def ipfs_client(operation: str) -> Iterator[Any]:
+    """Use a pooled IPFS client for one daemon operation, e.g. ``pin.add``.
+
+    The round-trip time is recorded against the operation name in the
+    metrics, and returned to the caller in the ``Server-Timing`` response
+    header.
+    """
+    start = time.perf_counter()
+    try:
+        with _get_pool().connection() as client:
+            yield client
+    finally:
+        _record_latency(operation, time.perf_counter() - start)
+
+
+def ipfs_cat(ipfs_hash: str) -> Iterator[bytes]:
+    """Stream an object from the daemon using a pooled client.
+
+    The client is held until the download is finished or abandoned, so that
+    downloads count against IPFS_POOL_SIZE like any other daemon operation.
+    The first chunk is read before returning so that errors can still be
+    reported to the caller, and the ``cat`` latency covers the whole download.
+    """
+    with ExitStack() as stack:
+        client = stack.enter_context(ipfs_client("cat"))
+        chunks = client.cat(ipfs_hash, stream=True)
+        first = next(chunks, b"")
+        connection = stack.pop_all()
+
+    def _generate() -> Iterator[bytes]:
+        with connection:
+            try:
+                yield first
+                yield from chunks
+            finally:
+                chunks.close()
+
+    return _generate()
+
+
+@app.after_request
+def _add_server_timing(response: Any) -> Any:
+    timings = g.get("ipfs_timings")
+    if timings:
+        response.headers.add(
+            "Server-Timing",
+            ", ".join(
+                "ipfs-{};dur={:.1f}".format(
+                    operation.replace(".", "-"), duration * 1000
+                )
+                for operation, duration in timings
+            ),
+        )
+    return response
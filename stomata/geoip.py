@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+#
+# pylint: disable=invalid-name,cyclic-import
+
+"""Country lookups for client addresses.
+
+The GeoIP CSV is compiled using ``flask geoip-compile`` into a small file of
+sorted address ranges, which is memory mapped and searched with a bisection.
+The file is reloaded when it changes, so the data can be refreshed by
+compiling it again without restarting the server.
+"""
+
+import os
+import re
+import csv
+import gzip
+import mmap
+import time
+import bisect
+import socket
+import struct
+import ipaddress
+import threading
+import functools
+from array import array
+from typing import Any, Iterator, List, Optional, Tuple
+
+from flask import request
+
+from stomata import app
+from .metrics import GEOIP_BLOCKED
+
+_MAGIC = b"STGEOIP1"
+_HEADER = struct.Struct("=8sI")
+
+
+def read_geoip_csv(filename: str) -> Iterator[Tuple[int, int, str]]:
+    """ read the first address, last address and country code of each range """
+    if filename.endswith(".gz"):
+        with gzip.open(filename, "rb") as gz:
+            blob = gz.read()
+    else:
+        with open(filename, "rb") as f:
+            blob = f.read()
+    for row in csv.reader(blob.decode("utf-8", "ignore").splitlines()):
+        try:
+            yield int(row[0]), int(row[1]), row[4]
+        except (IndexError, ValueError) as _:
+            pass
+
+
+def compile_index(csv_filename: str, index_filename: str) -> int:
+    """Compile the GeoIP CSV into the index, returning the number of ranges.
+
+    Adjacent ranges in the same country are merged, and the index is replaced
+    atomically so that running servers never see a partial file.
+    """
+    starts = array("I")
+    ends = array("I")
+    codes: List[bytes] = []
+    for addr_from, addr_to, country_code in sorted(read_geoip_csv(csv_filename)):
+        code = country_code.encode("ascii", "replace")[:2].ljust(2)
+        if starts and addr_from <= ends[-1] + 1:
+            if code == codes[-1]:
+                ends[-1] = max(ends[-1], addr_to)
+                continue
+            addr_from = ends[-1] + 1
+            if addr_from > addr_to:
+                continue
+        starts.append(addr_from)
+        ends.append(addr_to)
+        codes.append(code)
+    with open(index_filename + ".tmp", "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, len(starts)))
+        f.write(starts.tobytes())
+        f.write(ends.tobytes())
+        f.write(b"".join(codes))
+    os.replace(index_filename + ".tmp", index_filename)
+    return len(starts)
+
+
+class GeoIpIndex:
+    """ a memory mapped index of the country of each IPv4 address range """
+
+    def __init__(self, filename: str, reload_interval: float = 10) -> None:
+        self.filename = filename
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._data: Optional[Tuple[Any, Any, Any, Any]] = None
+        self._retired: Optional[Tuple[Any, Any, Any, Any]] = None
+        self._stat: Optional[Tuple[int, int]] = None
+        self._checked: float = 0
+
+    def _retire(self, data: Optional[Tuple[Any, Any, Any, Any]]) -> None:
+
+        # lookups do not take the lock, so the replaced mapping is only closed
+        # on the next reload when nothing can still be searching it
+        old, self._retired = self._retired, data
+        if not old:
+            return
+        mm, starts, ends, _ = old
+        starts.release()
+        ends.release()
+        try:
+            mm.close()
+        except BufferError as _:
+            pass
+
+    def _load(self) -> None:
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError as _:
+            self._retire(self._data)
+            self._data = None
+            self._stat = None
+            return
+        if (st.st_ino, st.st_mtime_ns) == self._stat:
+            self._retire(None)
+            return
+        with open(self.filename, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = _HEADER.unpack_from(mm)
+        if magic != _MAGIC:
+            mm.close()
+            raise ValueError("{} is not a GeoIP index".format(self.filename))
+        view = memoryview(mm)[_HEADER.size :]
+        starts = view[: count * 4].cast("I")
+        ends = view[count * 4 : count * 8].cast("I")
+        del view
+        self._retire(self._data)
+        self._data = (mm, starts, ends, _HEADER.size + count * 8)
+        self._stat = (st.st_ino, st.st_mtime_ns)
+
+    def _reload_if_changed(self) -> None:
+        now = time.monotonic()
+        if now - self._checked < self.reload_interval:
+            return
+        with self._lock:
+            if now - self._checked < self.reload_interval:
+                return
+            self._checked = now
+            try:
+                self._load()
+            except (OSError, ValueError, struct.error) as e:
+                app.logger.warning("failed to load %s: %s", self.filename, str(e))
+
+    def lookup(self, addr: str) -> Optional[str]:
+        """ get the country code for an IPv4 address, or None if unknown """
+        self._reload_if_changed()
+        data = self._data
+        if not data:
+            return None
+        try:
+            value = int.from_bytes(socket.inet_aton(addr), "big")
+        except OSError as _:
+            return None
+        mm, starts, ends, codes_offset = data
+        i = bisect.bisect_right(starts, value) - 1
+        if i < 0 or value > ends[i]:
+            return None
+        offset = codes_offset + i * 2
+        return mm[offset : offset + 2].decode("ascii")
+
+
+_index: Optional[GeoIpIndex] = None
+_index_lock = threading.Lock()
+
+
+def _get_index() -> Optional[GeoIpIndex]:
+    global _index  # pylint: disable=global-statement
+    if not app.config.get("GEOIP_INDEX"):
+        return None
+    with _index_lock:
+        if not _index:
+            _index = GeoIpIndex(
+                app.config["GEOIP_INDEX"],
+                reload_interval=app.config.get("GEOIP_RELOAD_INTERVAL", 10),
+            )
+        return _index
+
+
+@functools.lru_cache(maxsize=1)
+def _trusted_networks(proxies: Tuple[str, ...]) -> List[Any]:
+    return [ipaddress.ip_network(proxy, strict=False) for proxy in proxies]
+
+
+def _is_trusted_proxy(addr: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(addr)
+    except ValueError as _:
+        return False
+    proxies = app.config.get("GEOIP_TRUSTED_PROXIES", ["127.0.0.1", "::1"])
+    for network in _trusted_networks(tuple(proxies)):
+        if ip in network:
+            return True
+    return False
+
+
+def client_ip() -> Optional[str]:
+    """Get the address of the client making the request.
+
+    X-Forwarded-For is only used when the request comes from a trusted proxy,
+    in which case the client is the last address not added by a trusted proxy.
+    """
+    addr = request.remote_addr
+    if not addr or not _is_trusted_proxy(addr):
+        return addr
+    for forwarded in reversed(request.headers.get("X-Forwarded-For", "").split(",")):
+        forwarded = forwarded.strip()
+        if not forwarded:
+            continue
+        if not _is_trusted_proxy(forwarded):
+            return forwarded
+        addr = forwarded
+    return addr
+
+
+def client_country() -> Optional[str]:
+    """ get the country code of the client, or None if not known """
+    index = _get_index()
+    if not index:
+        return None
+    addr = client_ip()
+    if not addr:
+        return None
+    return index.lookup(addr)
+
+
+def is_banned(banned_country_codes: Optional[str]) -> bool:
+    """Check if the client is in a country the object is banned in.
+
+    The ``bannedCountryCodes`` attribute is stored as the string of a list,
+    so any two-letter upper case codes are matched.
+    """
+    if not banned_country_codes:
+        return False
+    country_code = client_country()
+    if not country_code:
+        return False
+    if country_code not in re.findall(r"\b[A-Z]{2}\b", banned_country_codes):
+        return False
+    GEOIP_BLOCKED.labels(country_code).inc()
+    return True
+
+
+@app.before_request
+def _geoip_block_all() -> Any:
+    if not app.config.get("GEOIP_BLOCK_ALL", False):
+        return None
+    country_code = client_country()
+    if country_code not in app.config["BANNED_COUNTRY_CODES"]:
+        return None
+    GEOIP_BLOCKED.labels(country_code).inc()
+    return {"error": "Not available in {}".format(country_code)}, 451
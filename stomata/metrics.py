@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+#
+# pylint: disable=invalid-name,cyclic-import,unused-argument
+
+"""Prometheus metrics.
+
+When running under gunicorn with several workers set PROMETHEUS_MULTIPROC_DIR
+to an empty directory so that ``/metrics`` can aggregate all the workers. The
+worker process has to use the same directory for its metrics to be exported.
+"""
+
+import os
+import time
+from typing import Any
+
+from flask import g, has_request_context, request
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from stomata import app
+
+REQUEST_LATENCY = Histogram(
+    "stomata_request_duration_seconds",
+    "Time taken to handle a request",
+    ["endpoint", "method", "status"],
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "stomata_requests_in_flight",
+    "Number of requests currently being handled",
+    multiprocess_mode="livesum",
+)
+DB_QUERIES = Histogram(
+    "stomata_request_db_queries",
+    "Number of database queries made by a request",
+    ["endpoint"],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 500, 1000, float("inf")),
+)
+DB_DURATION = Histogram(
+    "stomata_request_db_duration_seconds",
+    "Time spent in database queries by a request",
+    ["endpoint"],
+)
+IPFS_LATENCY = Histogram(
+    "stomata_ipfs_call_duration_seconds",
+    "Time taken by a call to the IPFS daemon",
+    ["operation"],
+)
+UPLOAD_BYTES = Counter(
+    "stomata_upload_bytes_total",
+    "Number of bytes uploaded to the IPFS daemon",
+)
+UPLOAD_THROUGHPUT = Histogram(
+    "stomata_upload_bytes_per_second",
+    "Rate at which each upload was streamed to the IPFS daemon",
+    buckets=(0x10000, 0x40000, 0x100000, 0x400000, 0x1000000, 0x4000000, 0x10000000),
+)
+
+GEOIP_BLOCKED = Counter(
+    "stomata_geoip_blocked_total",
+    "Number of requests refused because of the country of the client",
+    ["country"],
+)
+UPLOAD_DEDUP = Counter(
+    "stomata_upload_dedup_total",
+    "Number of uploads that were already pinned and so not added",
+)
+UPLOAD_DEDUP_BYTES = Counter(
+    "stomata_upload_dedup_bytes_total",
+    "Number of bytes not written to the IPFS repo as they were already pinned",
+)
+IPFS_REPO_SIZE = Gauge(
+    "stomata_ipfs_repo_size_bytes",
+    "Size of the IPFS repo when last checked by the worker",
+    multiprocess_mode="livesum",
+)
+PIN_SIZE_BACKLOG = Gauge(
+    "stomata_pin_size_backlog",
+    "Number of pinned objects with a size that has not been resolved yet",
+    multiprocess_mode="livesum",
+)
+GC_RUNS = Counter(
+    "stomata_gc_runs_total",
+    "Number of times garbage was collected, by what triggered it",
+    ["trigger"],
+)
+GC_RECLAIMED_BYTES = Counter(
+    "stomata_gc_reclaimed_bytes_total",
+    "Number of bytes removed from the IPFS repo by garbage collection",
+)
+JSON_DIGEST_LOOKUPS = Counter(
+    "stomata_json_digest_lookups_total",
+    "Lookups of pinJSONToIPFS content, by where the digest was found",
+    ["result"],
+)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(
+    conn: Any,
+    cursor: Any,
+    statement: Any,
+    parameters: Any,
+    context: Any,
+    executemany: Any,
+) -> None:
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(
+    conn: Any,
+    cursor: Any,
+    statement: Any,
+    parameters: Any,
+    context: Any,
+    executemany: Any,
+) -> None:
+    duration = time.perf_counter() - conn.info["query_start"].pop()
+    if has_request_context() and "db_queries" in g:
+        g.db_queries += 1
+        g.db_duration += duration
+
+
+@app.before_request
+def _metrics_before_request() -> None:
+    g.request_start = time.perf_counter()
+    g.db_queries = 0
+    g.db_duration = 0.0
+    REQUESTS_IN_FLIGHT.inc()
+
+
+@app.after_request
+def _metrics_after_request(response: Any) -> Any:
+    endpoint = request.endpoint or "unknown"
+    REQUEST_LATENCY.labels(endpoint, request.method, response.status_code).observe(
+        time.perf_counter() - g.request_start
+    )
+    DB_QUERIES.labels(endpoint).observe(g.db_queries)
+    DB_DURATION.labels(endpoint).observe(g.db_duration)
+    return response
+
+
+@app.teardown_request
+def _metrics_teardown_request(exc: Any) -> None:
+    if "request_start" in g:
+        REQUESTS_IN_FLIGHT.dec()
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics() -> Any:
+    """ the Prometheus metrics for this server """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), 200, {"Content-Type": CONTENT_TYPE_LATEST}
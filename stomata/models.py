@@ -9,8 +9,11 @@
 
 """ objects """
 
+import json
 import datetime
-from typing import Any, List, Optional
+from typing import Any, Dict, Optional
+
+from sqlalchemy.orm.collections import attribute_mapped_collection
 
 from stomata import db
 
@@ -19,6 +22,10 @@ class IpfsAttr(db.Model):
     """ optional attribute on the Ipfs object """
 
     __tablename__ = "ipfs_attr"
+    __table_args__ = (
+        db.UniqueConstraint("ipfs_id", "key", name="uq_ipfs_attr_ipfs_id_key"),
+        db.Index("ix_ipfs_attr_key_value", "key", "value"),
+    )
 
     ipfs_attribute_id = db.Column(db.Integer, primary_key=True)
     ipfs_id = db.Column(
@@ -40,27 +47,240 @@ class Ipfs(db.Model):
     """ a pinned IPFS object """
 
     __tablename__ = "ipfs"
+    __table_args__ = (
+        db.Index(
+            "ix_ipfs_pin_hash_trgm",
+            "pin_hash",
+            postgresql_using="gin",
+            postgresql_ops={"pin_hash": "gin_trgm_ops"},
+        ),
+        db.Index(
+            "ix_ipfs_size_pending",
+            "ipfs_id",
+            postgresql_where=db.text("size IS NULL AND date_unpinned IS NULL"),
+        ),
+    )
 
     ipfs_id = db.Column(db.Integer, primary_key=True)
-    pin_hash = db.Column(db.String, nullable=False)
+    pin_hash = db.Column(db.String, nullable=False, unique=True, index=True)
+    user_id: str = db.Column(db.String, nullable=False, index=True)
     name: str = db.Column(db.String, default=None)
     date_pinned = db.Column(
         db.DateTime, nullable=False, default=datetime.datetime.utcnow
     )
-    size: int = db.Column(db.Integer, default=0)
-    attrs: List[IpfsAttr] = db.relationship(
+    date_unpinned = db.Column(db.DateTime, default=None)
+    # NULL until the size of a pinByHash object is resolved by the worker
+    size: Optional[int] = db.Column(db.BigInteger, default=None)
+    attrs: Dict[str, IpfsAttr] = db.relationship(
         "IpfsAttr",
         back_populates="ipfs",
         lazy="joined",
+        collection_class=attribute_mapped_collection("key"),
         cascade="all,delete,delete-orphan",
     )
 
-    def attr(self, key: str) -> Optional[str]:
+    def attr(self, key: str) -> Optional[IpfsAttr]:
         """ return the attribute with the key name """
-        for attr in self.attrs:
-            if attr.key == key:
-                return attr
-        return None
+        return self.attrs.get(key)
 
     def __repr__(self) -> str:
         return "Ipfs({})".format(self.ipfs_id)
+
+
+class PinJob(db.Model):
+    """ a queued request to pin an existing IPFS object """
+
+    __tablename__ = "pin_jobs"
+
+    pin_job_id = db.Column(db.Integer, primary_key=True)
+    pin_hash = db.Column(db.String, nullable=False, unique=True)
+    user_id: str = db.Column(db.String, nullable=False)
+    name: str = db.Column(db.String, default=None)
+    md: str = db.Column(db.Text, default=None)
+    status = db.Column(db.String, nullable=False, default="searching")
+    attempts: int = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, default=None)
+    date_queued = db.Column(
+        db.DateTime, nullable=False, default=datetime.datetime.utcnow
+    )
+    date_next_attempt = db.Column(
+        db.DateTime, nullable=False, default=datetime.datetime.utcnow, index=True
+    )
+
+    @property
+    def metadata_dict(self) -> Dict[str, Any]:
+        """ return the pinataMetadata the job was queued with """
+        if not self.md:
+            return {}
+        return json.loads(self.md)
+
+    def __repr__(self) -> str:
+        return "PinJob({}:{})".format(self.pin_hash, self.status)
+
+
+class IpnsPublish(db.Model):
+    """The pending and last IPNS publish for a key.
+
+    There is only one row for each key, so publishing a new hash before the
+    previous one has been processed replaces it rather than queuing both.
+    """
+
+    __tablename__ = "ipns_publishes"
+
+    ipns_publish_id = db.Column(db.Integer, primary_key=True)
+    key: str = db.Column(db.String, nullable=False, unique=True)
+    pin_hash = db.Column(db.String, nullable=False)
+    status = db.Column(db.String, nullable=False, default="queued")
+    attempts: int = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, default=None)
+    ipns_hash = db.Column(db.String, default=None)
+    published_hash = db.Column(db.String, default=None)
+    date_queued = db.Column(
+        db.DateTime, nullable=False, default=datetime.datetime.utcnow
+    )
+    date_next_attempt = db.Column(
+        db.DateTime, nullable=False, default=datetime.datetime.utcnow, index=True
+    )
+    date_published = db.Column(db.DateTime, default=None)
+
+    def __repr__(self) -> str:
+        return "IpnsPublish({}:{})".format(self.key, self.status)
+
+
+class ApiKey(db.Model):
+    """ an API key, of which only a hash of the secret is stored """
+
+    __tablename__ = "api_keys"
+
+    api_key_id = db.Column(db.Integer, primary_key=True)
+    api_key: str = db.Column(db.String, nullable=False, unique=True)
+    secret_hash: str = db.Column(db.String, nullable=False)
+    user_id: str = db.Column(db.String, nullable=False)
+    name: str = db.Column(db.String, default=None)
+    admin: bool = db.Column(db.Boolean, nullable=False, default=False)
+    date_created = db.Column(
+        db.DateTime, nullable=False, default=datetime.datetime.utcnow
+    )
+    date_revoked = db.Column(db.DateTime, default=None)
+
+    def __repr__(self) -> str:
+        return "ApiKey({})".format(self.api_key)
+
+
+class UserUsage(db.Model):
+    """The number and total size of the objects pinned by a user.
+
+    This is updated in the same transaction as the Ipfs rows so that usage
+    can be read without scanning the ipfs table.
+    """
+
+    __tablename__ = "user_usage"
+
+    user_id: str = db.Column(db.String, primary_key=True)
+    pin_count: int = db.Column(db.Integer, nullable=False, default=0)
+    pin_size: int = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self) -> str:
+        return "UserUsage({}:{})".format(self.user_id, self.pin_count)
+
+
+class ChangeCounter(db.Model):
+    """A counter incremented in the same transaction as a change.
+
+    The ``pins`` counter changes whenever the pins, their metadata or the
+    usage totals change, and is used to make the ETags of the read routes.
+    The ``unpins`` counter is the number of objects unpinned, and
+    ``gc_unpins`` is its value when garbage was last collected.
+    """
+
+    __tablename__ = "change_counters"
+
+    name: str = db.Column(db.String, primary_key=True)
+    value: int = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self) -> str:
+        return "ChangeCounter({}:{})".format(self.name, self.value)
+
+
+class JsonDigest(db.Model):
+    """ the IPFS hash of some canonically serialized pinJSONToIPFS content """
+
+    __tablename__ = "json_digests"
+
+    digest: str = db.Column(db.String, primary_key=True)
+    pin_hash: str = db.Column(db.String, nullable=False)
+    date_created = db.Column(
+        db.DateTime, nullable=False, default=datetime.datetime.utcnow
+    )
+
+    def __repr__(self) -> str:
+        return "JsonDigest({}:{})".format(self.digest, self.pin_hash)
+
+
+class UploadChunk(db.Model):
+    """ a received part of a resumable upload """
+
+    __tablename__ = "upload_chunks"
+    __table_args__ = (
+        db.UniqueConstraint(
+            "upload_session_id", "offset", name="uq_upload_chunks_session_offset"
+        ),
+    )
+
+    upload_chunk_id = db.Column(db.Integer, primary_key=True)
+    upload_session_id = db.Column(
+        db.Integer,
+        db.ForeignKey("upload_sessions.upload_session_id"),
+        nullable=False,
+        index=True,
+    )
+    offset: int = db.Column(db.BigInteger, nullable=False)
+    length: int = db.Column(db.BigInteger, nullable=False)
+    checksum: str = db.Column(db.String, nullable=False)
+
+    def __repr__(self) -> str:
+        return "UploadChunk({}+{})".format(self.offset, self.length)
+
+
+class UploadSession(db.Model):
+    """ a resumable upload, spooled to disk until it is finalized """
+
+    __tablename__ = "upload_sessions"
+
+    upload_session_id = db.Column(db.Integer, primary_key=True)
+    user_id: str = db.Column(db.String, nullable=False)
+    name: str = db.Column(db.String, default=None)
+    md: str = db.Column(db.Text, default=None)
+    size: int = db.Column(db.BigInteger, nullable=False)
+    status = db.Column(db.String, nullable=False, default="uploading")
+    date_created = db.Column(
+        db.DateTime, nullable=False, default=datetime.datetime.utcnow
+    )
+    date_updated = db.Column(
+        db.DateTime, nullable=False, default=datetime.datetime.utcnow, index=True
+    )
+    chunks = db.relationship(
+        "UploadChunk",
+        order_by="UploadChunk.offset",
+        cascade="all,delete,delete-orphan",
+    )
+
+    @property
+    def metadata_dict(self) -> Dict[str, Any]:
+        """ return the pinataMetadata the upload was created with """
+        if not self.md:
+            return {}
+        return json.loads(self.md)
+
+    @property
+    def offset(self) -> int:
+        """ return the number of bytes received without any gaps """
+        offset = 0
+        for chunk in self.chunks:
+            if chunk.offset > offset:
+                break
+            offset = max(offset, chunk.offset + chunk.length)
+        return offset
+
+    def __repr__(self) -> str:
+        return "UploadSession({}:{})".format(self.upload_session_id, self.status)
@@ -10,18 +10,54 @@
 """ JSON and HTML routes """
 
 import json
+import hashlib
+import secrets
+import datetime
 
 import os
-from typing import Any, Dict
+import time
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Tuple
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 
 import ipfshttpclient
 
-from flask import request, render_template
+from flask import (
+    Response,
+    g,
+    make_response,
+    request,
+    render_template,
+    stream_with_context,
+)
+from sqlalchemy import and_, case, event, tuple_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
 from sqlalchemy.orm.exc import NoResultFound
 
 from stomata import app, db
-from .models import Ipfs, IpfsAttr
+from .auth import check_secret, hash_secret, invalidate_api_key, lookup_api_key
+from .cache import LruCache
+from .daemon import ipfs_cat, ipfs_client
+from .geoip import is_banned
+from .metrics import (
+    JSON_DIGEST_LOOKUPS,
+    UPLOAD_BYTES,
+    UPLOAD_DEDUP,
+    UPLOAD_DEDUP_BYTES,
+    UPLOAD_THROUGHPUT,
+)
+from .models import (
+    ApiKey,
+    ChangeCounter,
+    Ipfs,
+    IpfsAttr,
+    IpnsPublish,
+    JsonDigest,
+    PinJob,
+    UserUsage,
+)
 
 
 def api_key_required(f):  # type: ignore
@@ -31,32 +67,168 @@ def api_key_required(f):  # type: ignore
     def decorated_function(*args, **kwargs):  # type: ignore
         """ checks the API keys """
         try:
-            if request.headers.get("Pinata-Api-Key") != app.config["STOMATA_API_KEY"]:
-                return {
-                    "error": {
-                        "reason": "INVALID_API_KEYS",
-                        "details": "Invalid API key provided",
-                    }
-                }, 401
-            if (
-                request.headers.get("Pinata-Secret-Api-Key")
-                != app.config["STOMATA_SECRET_API_KEY"]
-            ):
-                return {
-                    "error": {
-                        "reason": "INVALID_API_KEYS",
-                        "details": "Invalid secret API key provided",
-                    }
-                }, 401
+            info = lookup_api_key(request.headers.get("Pinata-Api-Key", ""))
         except KeyError as e:
             return {"error": str(e)}, 500
+        if not info:
+            return {
+                "error": {
+                    "reason": "INVALID_API_KEYS",
+                    "details": "Invalid API key provided",
+                }
+            }, 401
+        if not check_secret(info, request.headers.get("Pinata-Secret-Api-Key", "")):
+            return {
+                "error": {
+                    "reason": "INVALID_API_KEYS",
+                    "details": "Invalid secret API key provided",
+                }
+            }, 401
 
         # success
+        g.api_key = info
         return f(*args, **kwargs)
 
     return decorated_function
 
 
+def admin_required(f):  # type: ignore
+    """ requires an admin API key, must be used after api_key_required """
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):  # type: ignore
+        """ checks the API key has admin permission """
+        if not g.api_key.admin:
+            return {
+                "error": {
+                    "reason": "NO_PERMISSIONS",
+                    "details": "An admin API key is required",
+                }
+            }, 403
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
+def _is_owner(ipfs: Ipfs) -> bool:
+    """ check the object was pinned by this user, or the API key is an admin """
+    return g.api_key.admin or ipfs.user_id == g.api_key.user_id
+
+
+def _update_usage(deltas: Dict[str, Tuple[int, int]]) -> None:
+    """Add to the pin count and total size of some users.
+
+    This does not commit, so that the counters change in the same transaction
+    as the Ipfs rows they are counting.
+    """
+    if not deltas:
+        return
+    table = UserUsage.__table__
+    stmt = postgresql.insert(table)
+    db.session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[table.c.user_id],
+            set_={
+                "pin_count": table.c.pin_count + stmt.excluded.pin_count,
+                "pin_size": table.c.pin_size + stmt.excluded.pin_size,
+            },
+        ),
+        # in a consistent order so concurrent updates cannot deadlock
+        [
+            {"user_id": user_id, "pin_count": count, "pin_size": size}
+            for user_id, (count, size) in sorted(deltas.items())
+        ],
+    )
+
+
+def _bump_changes(name: str = "pins", count: int = 1) -> None:
+    """Increment a change counter, by default the one used for ETags.
+
+    Every write shares the counter row, so holding its lock until the rows are
+    committed would serialize all writers. Instead the increment is made in a
+    separate short transaction once the rows have been committed, and is
+    dropped if they are rolled back.
+    """
+    pending: Dict[str, int] = db.session.info.setdefault("pending_changes", {})
+    pending[name] = pending.get(name, 0) + count
+
+
+def _increment_changes(pending: Dict[str, int]) -> None:
+    """ increment change counters in their own transaction """
+    table = ChangeCounter.__table__
+    with db.engine.begin() as conn:
+        for name in sorted(pending):
+            stmt = postgresql.insert(table).values(name=name, value=pending[name])
+            conn.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[table.c.name],
+                    set_={"value": table.c.value + pending[name]},
+                )
+            )
+
+
+@event.listens_for(db.session, "after_commit")
+def _after_commit(session: Any) -> None:
+    pending = session.info.pop("pending_changes", None)
+    if pending:
+        _increment_changes(pending)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _after_rollback(session: Any) -> None:
+    session.info.pop("pending_changes", None)
+
+
+def _get_changes(name: str = "pins") -> int:
+    """ get the value of a change counter """
+    value = (
+        db.session.query(ChangeCounter.value)
+        .filter(ChangeCounter.name == name)
+        .scalar()
+    )
+    return value or 0
+
+
+# responses are keyed by ETag, so entries for old counter values are unused
+_response_cache: Optional[LruCache] = None
+if app.config.get("RESPONSE_CACHE_SIZE", 0):
+    _response_cache = LruCache(app.config["RESPONSE_CACHE_SIZE"])
+
+
+def _conditional_response(func: Callable[[], Any], variant: str = "") -> Any:
+    """Get the response of a read route, or 304 if the client has it already.
+
+    The ETag is made from the change counter, the API key owner and the
+    request, so polling an unchanged list does not query the rows. The counter
+    is incremented after the rows are committed, so rows read after the
+    counter can only be newer and a stale ETag is never cached.
+    """
+    etag = hashlib.sha1(
+        "{}:{}:{}:{}:{}".format(
+            _get_changes(),
+            g.api_key.user_id,
+            g.api_key.admin,
+            request.full_path,
+            variant,
+        ).encode()
+    ).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    cached = _response_cache.get(etag) if _response_cache is not None else None
+    if cached:
+        response = Response(cached[0], mimetype=cached[1])
+    else:
+        response = make_response(func())
+        if response.status_code != 200:
+            return response
+        if _response_cache is not None and not response.is_streamed:
+            _response_cache.set(etag, (response.get_data(), response.mimetype))
+    response.set_etag(etag)
+    return response
+
+
 @app.route("/", methods=["GET"])
 def index() -> Any:
     """ the index page """
@@ -65,16 +237,135 @@ def index() -> Any:
 
 @app.route("/users/generateApiKey", methods=["POST"])
 @api_key_required
+@admin_required
 def generate_api_key() -> Any:
-    """ FIXME: generate an API key """
-    return {}, 404
+    """Generate an API key.
+
+    The key belongs to the same user as the API key used to create it, unless
+    a Stomata-specific ``userId`` is specified. The secret is only returned
+    here, as only a hash of it is stored.
+    """
+
+    try:
+        payload = json.loads(request.data.decode("utf8"))
+        name = payload["keyName"]
+    except KeyError as e:
+        return {"error": str(e)}, 500
+    admin = bool(payload.get("permissions", {}).get("admin", False))
+
+    secret = secrets.token_hex(32)
+    key = ApiKey(
+        api_key=secrets.token_hex(10),
+        secret_hash=hash_secret(secret),
+        user_id=payload.get("userId", g.api_key.user_id),
+        name=name,
+        admin=admin,
+    )
+    db.session.add(key)
+    db.session.commit()
+
+    # success
+    return {"pinata_api_key": key.api_key, "pinata_api_secret": secret}
 
 
 @app.route("/users/revokeApiKey", methods=["PUT"])
 @api_key_required
+@admin_required
 def revoke_api_key() -> Any:
-    """ FIXME: revoke an API key """
-    return {}, 404
+    """ revoke an API key """
+
+    try:
+        payload = json.loads(request.data.decode("utf8"))
+        api_key = payload["apiKey"]
+    except KeyError as e:
+        return {"error": str(e)}, 500
+
+    # find in database
+    try:
+        key = (
+            db.session.query(ApiKey)
+            .filter(ApiKey.api_key == api_key)
+            .filter(ApiKey.date_revoked == None)
+            .one()
+        )
+    except NoResultFound as e:
+        return {"error": str(e)}, 500
+    key.date_revoked = datetime.datetime.utcnow()
+    db.session.commit()
+    invalidate_api_key(api_key)
+
+    # success
+    return "Revoked", 200
+
+
+def _set_metadata(items: List[Tuple[Ipfs, Dict[str, Any]]]) -> None:
+    """Set the name and keyvalues from hashMetadata payloads.
+
+    Rather than loading and flushing each attribute, all the keyvalues are
+    written using one INSERT ... ON CONFLICT DO UPDATE and the keys set to
+    null are removed using one DELETE. When the same key of the same object
+    is set more than once the last value in the request wins, so each row is
+    only affected once.
+    """
+    values: Dict[Tuple[int, str], Optional[str]] = {}
+    for ipfs, payload in items:
+        if "name" in payload:
+            ipfs.name = payload["name"]
+        keyvalues = payload.get("keyvalues", {})
+        for key in keyvalues:
+            value = keyvalues[key]
+            values[(ipfs.ipfs_id, key)] = None if value == None else str(value)
+    deletes = [ipfs_key for ipfs_key, value in values.items() if value is None]
+    upserts = [
+        {"ipfs_id": ipfs_id, "key": key, "value": value}
+        for (ipfs_id, key), value in values.items()
+        if value is not None
+    ]
+
+    chunk_size = app.config.get("SQL_IN_CHUNK_SIZE", 5000)
+    for i in range(0, len(deletes), chunk_size):
+        db.session.query(IpfsAttr).filter(
+            tuple_(IpfsAttr.ipfs_id, IpfsAttr.key).in_(deletes[i : i + chunk_size])
+        ).delete(synchronize_session=False)
+    if upserts:
+        stmt = postgresql.insert(IpfsAttr.__table__)
+        db.session.execute(
+            stmt.on_conflict_do_update(
+                constraint="uq_ipfs_attr_ipfs_id_key",
+                set_={"value": stmt.excluded.value},
+            ),
+            upserts,
+        )
+    for ipfs, _ in items:
+        db.session.expire(ipfs, ["attrs"])
+    if items:
+        _bump_changes()
+
+
+def _ipfs_for_hashes(ipfs_hashes: List[str]) -> Dict[str, Ipfs]:
+    """ look up the Ipfs objects for a list of hashes using batched queries """
+    chunk_size = app.config.get("SQL_IN_CHUNK_SIZE", 5000)
+    ipfs_for_hash: Dict[str, Ipfs] = {}
+    for i in range(0, len(ipfs_hashes), chunk_size):
+        for ipfs in db.session.query(Ipfs).filter(
+            Ipfs.pin_hash.in_(ipfs_hashes[i : i + chunk_size])
+        ):
+            ipfs_for_hash[ipfs.pin_hash] = ipfs
+    return ipfs_for_hash
+
+
+def _batch_payload(key: str) -> List[Any]:
+    """ get the list of items from a batch request """
+    items = json.loads(request.data.decode("utf8"))[key]
+    if not isinstance(items, list):
+        raise ValueError("{} is not a list".format(key))
+    if len(items) > app.config.get("BATCH_MAX_ITEMS", 10000):
+        raise ValueError(
+            "{} has more than {} items".format(
+                key, app.config.get("BATCH_MAX_ITEMS", 10000)
+            )
+        )
+    return items
 
 
 @app.route("/pinning/hashMetadata", methods=["PUT"])
@@ -94,25 +385,52 @@ def hash_metadata() -> Any:
         ipfs = db.session.query(Ipfs).filter(Ipfs.pin_hash == ipfs_hash).one()
     except NoResultFound as e:
         return {"error": str(e)}, 500
+    if not _is_owner(ipfs):
+        return {"error": "Current user has not pinned hash: {}".format(ipfs_hash)}, 500
 
-    if "name" in payload:
-        ipfs.name = payload["name"]
-    keyvalues = payload.get("keyvalues", {})
-    for key in keyvalues:
-        attr = ipfs.attr(key)
-        if attr:
-            if keyvalues[key] == None:
-                ipfs.attrs.remove(attr)
-                continue
-            attr.value = keyvalues[key]
-            continue
-        ipfs.attrs.append(IpfsAttr(key=key, value=keyvalues[key]))
+    _set_metadata([(ipfs, payload)])
     db.session.commit()
 
     # success
     return "OK", 200
 
 
+@app.route("/pinning/hashMetadataBatch", methods=["PUT"])
+@api_key_required
+def hash_metadata_batch() -> Any:
+    """Set metadata on several existing Ipfs objects in one transaction.
+
+    The ``items`` list has the same objects as used by ``hashMetadata``.
+    """
+
+    try:
+        items = _batch_payload("items")
+        ipfs_hashes = [item["ipfsPinHash"] for item in items]
+    except (KeyError, TypeError, ValueError) as e:
+        return {"error": str(e)}, 400
+
+    ipfs_for_hash = _ipfs_for_hashes(ipfs_hashes)
+    rows = []
+    updates = []
+    for item in items:
+        ipfs = ipfs_for_hash.get(item["ipfsPinHash"])
+        if not ipfs or not _is_owner(ipfs):
+            rows.append(
+                {
+                    "ipfsPinHash": item["ipfsPinHash"],
+                    "error": "Not pinned",
+                }
+            )
+            continue
+        updates.append((ipfs, item))
+        rows.append({"ipfsPinHash": item["ipfsPinHash"], "status": "OK"})
+    _set_metadata(updates)
+    db.session.commit()
+
+    # success
+    return {"count": len(rows), "rows": rows}
+
+
 @app.route("/hashPinPolicy", methods=["PUT"])
 @api_key_required
 def hash_pin_policy() -> Any:
@@ -120,23 +438,81 @@ def hash_pin_policy() -> Any:
     return {}, 404
 
 
-def _add_to_db(ipfs_hash, md) -> None:
-    """ add an added IPFS hash to the database """
-    ipfs = Ipfs(pin_hash=ipfs_hash)
+def _add_to_db(ipfs_hash: str, md: Optional[Dict[str, Any]], user_id: str) -> Ipfs:
+    """Add an added IPFS hash to the database, owned by a user.
+
+    Raises IntegrityError if the hash is already in the database.
+    """
+    ipfs = Ipfs(pin_hash=ipfs_hash, user_id=user_id)
     if md:
-        ipfs.name = os.path.basename(md.get("name"))
-        ipfs.size = md.get("size", 0)
+        if md.get("name"):
+            ipfs.name = os.path.basename(md["name"])
+        ipfs.size = md.get("size")
         keyvalues = md.get("keyvalues", {})
         for key in keyvalues:
-            ipfs.attrs.append(IpfsAttr(key=key, value=str(keyvalues[key])))
+            ipfs.attrs[key] = IpfsAttr(key=key, value=str(keyvalues[key]))
     db.session.add(ipfs)
+    _update_usage({user_id: (1, ipfs.size or 0)})
+    _bump_changes()
+    try:
+        db.session.commit()
+    except IntegrityError as _:
+        db.session.rollback()
+        raise
+    return ipfs
+
+
+def _repin_in_db(ipfs: Ipfs, md: Dict[str, Any], user_id: str) -> Ipfs:
+    """Mark an object that was unpinned from the daemon as pinned again.
+
+    The object is now owned by the user that pinned it again, with the new
+    metadata. If it is pinned again concurrently the usage is only counted
+    once.
+    """
+    values: Dict[Any, Any] = {
+        Ipfs.user_id: user_id,
+        Ipfs.size: md.get("size"),
+        Ipfs.date_pinned: datetime.datetime.utcnow(),
+        Ipfs.date_unpinned: None,
+    }
+    if md.get("name"):
+        values[Ipfs.name] = os.path.basename(md["name"])
+    repinned = (
+        db.session.query(Ipfs)
+        .filter(Ipfs.ipfs_id == ipfs.ipfs_id)
+        .filter(Ipfs.date_unpinned != None)
+        .update(values, synchronize_session=False)
+    )
+    if repinned:
+        _update_usage({user_id: (1, md.get("size") or 0)})
+        _set_metadata([(ipfs, {"keyvalues": md.get("keyvalues") or {}})])
     db.session.commit()
+    return ipfs
+
+
+def _pin_job_values(
+    ipfs_hash: str, md: Optional[Dict[str, Any]], user_id: str
+) -> Dict[str, Any]:
+    """ get the column values for a new PinJob """
+    values = {
+        "pin_hash": ipfs_hash,
+        "user_id": user_id,
+        "md": json.dumps(md or {}),
+        "name": None,
+    }
+    if md and md.get("name"):
+        values["name"] = os.path.basename(md["name"])
+    return values
 
 
 @app.route("/pinning/pinByHash", methods=["POST"])
 @api_key_required
 def pin_by_hash() -> Any:
-    """ pin an existing upload to IPFS """
+    """Pin an existing upload to IPFS.
+
+    The object may have to be fetched from the network, so the pin is queued
+    and processed by ``flask worker`` rather than in the request.
+    """
 
     # get ipfs hash
     try:
@@ -145,31 +521,208 @@ def pin_by_hash() -> Any:
     except KeyError as e:
         return {"error": str(e)}, 500
 
-    # find in database
+    # find in database, objects unpinned from the daemon can be pinned again
     ipfs = db.session.query(Ipfs).filter(Ipfs.pin_hash == ipfs_hash).first()
-    if ipfs:
+    if ipfs and not ipfs.date_unpinned:
         return {"error": "Already pinned"}, 400
 
-    # proxy
+    # add to queue, the unique pin_hash means this fails if already queued
+    job = PinJob(
+        **_pin_job_values(ipfs_hash, payload.get("pinataMetadata"), g.api_key.user_id)
+    )
+    db.session.add(job)
     try:
-        with ipfshttpclient.connect() as client:
-            client.pin.add(ipfs_hash)
-    except KeyError as e:
-        return {"error": str(e)}, 500
-
-    # add to database
-    md = payload.get("pinataMetadata")
-    _add_to_db(ipfs_hash, md)
+        db.session.commit()
+    except IntegrityError as _:
+        db.session.rollback()
+        job = db.session.query(PinJob).filter(PinJob.pin_hash == ipfs_hash).one()
+        if job.status != "expired":
+            return {"error": "Already queued"}, 400
+        job.status = "searching"
+        job.attempts = 0
+        job.error = None
+        job.date_next_attempt = datetime.datetime.utcnow()
+        db.session.commit()
 
     # success -- yes: this is a different case to pinFileToIPFS...
     return {
-        "id": ipfs.ipfs_id,
+        "id": job.pin_job_id,
         "ipfsHash": ipfs_hash,
-        "status": "searching",
-        "name": ipfs.name,
+        "status": job.status,
+        "name": job.name,
     }
 
 
+@app.route("/pinning/pinByHashBatch", methods=["POST"])
+@api_key_required
+def pin_by_hash_batch() -> Any:
+    """Queue several existing uploads to be pinned in one transaction.
+
+    The ``pins`` list has the same objects as used by ``pinByHash``.
+    """
+
+    try:
+        items = _batch_payload("pins")
+        ipfs_hashes = [item["hashToPin"] for item in items]
+    except (KeyError, TypeError, ValueError) as e:
+        return {"error": str(e)}, 400
+
+    # find any already pinned or queued
+    ipfs_for_hash = {
+        ipfs_hash: ipfs
+        for ipfs_hash, ipfs in _ipfs_for_hashes(ipfs_hashes).items()
+        if not ipfs.date_unpinned
+    }
+    job_for_hash = _pin_jobs_for_hashes(ipfs_hashes)
+
+    # queue the rest using a single multi-row INSERT
+    values: Dict[str, Dict[str, Any]] = {}
+    for item in items:
+        ipfs_hash = item["hashToPin"]
+        if ipfs_hash in ipfs_for_hash or ipfs_hash in job_for_hash:
+            continue
+        values[ipfs_hash] = _pin_job_values(
+            ipfs_hash, item.get("pinataMetadata"), g.api_key.user_id
+        )
+    if values:
+        try:
+            db.session.execute(PinJob.__table__.insert(), list(values.values()))
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            return {"error": "Already queued: {}".format(str(e.orig))}, 409
+        job_for_hash.update(_pin_jobs_for_hashes(list(values)))
+
+    rows = []
+    for ipfs_hash in ipfs_hashes:
+        if ipfs_hash in ipfs_for_hash:
+            rows.append({"ipfsHash": ipfs_hash, "error": "Already pinned"})
+            continue
+        job = job_for_hash[ipfs_hash]
+        if ipfs_hash not in values:
+            rows.append({"ipfsHash": ipfs_hash, "error": "Already queued"})
+            continue
+        rows.append(
+            {
+                "id": job.pin_job_id,
+                "ipfsHash": ipfs_hash,
+                "status": job.status,
+                "name": job.name,
+            }
+        )
+    return {"count": len(rows), "rows": rows}
+
+
+def _pin_jobs_for_hashes(ipfs_hashes: List[str]) -> Dict[str, PinJob]:
+    """ look up the PinJob objects for a list of hashes using batched queries """
+    chunk_size = app.config.get("SQL_IN_CHUNK_SIZE", 5000)
+    job_for_hash: Dict[str, PinJob] = {}
+    for i in range(0, len(ipfs_hashes), chunk_size):
+        for job in db.session.query(PinJob).filter(
+            PinJob.pin_hash.in_(ipfs_hashes[i : i + chunk_size])
+        ):
+            job_for_hash[job.pin_hash] = job
+    return job_for_hash
+
+
+class _CountingReader:
+    """ a file-like wrapper that counts the bytes read through it """
+
+    def __init__(self, stream: IO[bytes]) -> None:
+        self.stream = stream
+        self.size: int = 0
+
+    def read(self, size: int = -1) -> bytes:
+        """ read from the wrapped stream """
+        buf = self.stream.read(size)
+        self.size += len(buf)
+        return buf
+
+
+def _pin_file_response(ipfs: Ipfs) -> Dict[str, Any]:
+    """ get the pinFileToIPFS JSON for a given Ipfs object """
+    return {
+        "IpfsHash": ipfs.pin_hash,
+        "PinSize": ipfs.size or 0,
+        "Name": ipfs.name,
+        "Timestamp": ipfs.date_pinned.isoformat(),
+    }
+
+
+def _check_banned_country_codes(keyvalues: Dict[str, Any]) -> Optional[str]:
+    """ check the server bans every country the object should be banned in """
+    for country_code in keyvalues.get("bannedCountryCodes", []):
+        if country_code not in app.config["BANNED_COUNTRY_CODES"]:
+            return (
+                "country code {} is not included in server "
+                "BANNED_COUNTRY_CODES=[{}]".format(
+                    country_code, ",".join(app.config["BANNED_COUNTRY_CODES"])
+                )
+            )
+    return None
+
+
+def _pin_stream(
+    fileobj: IO[bytes], name: Optional[str], keyvalues: Dict[str, Any]
+) -> Any:
+    """Add a seekable file to the IPFS, pin it and add it to the database.
+
+    Returns the pinFileToIPFS response.
+    """
+
+    # hash without writing any blocks, so re-uploading a file that is already
+    # pinned does not cost any disk I/O on the IPFS repo
+    if app.config.get("UPLOAD_ONLY_HASH_FIRST", True):
+        stream = _CountingReader(fileobj)
+        try:
+            with ipfs_client("add.only-hash") as client:
+                ipfs_hash = client.add(stream, only_hash=True)["Hash"]
+        except ipfshttpclient.exceptions.ErrorResponse as e:
+            return {"error": str(e)}, 500
+        ipfs = db.session.query(Ipfs).filter(Ipfs.pin_hash == ipfs_hash).first()
+        if ipfs and not ipfs.date_unpinned:
+            UPLOAD_DEDUP.inc()
+            UPLOAD_DEDUP_BYTES.inc(stream.size)
+            return _pin_file_response(ipfs)
+        fileobj.seek(0)
+
+    # proxy, streaming the upload to the daemon a chunk at a time
+    stream = _CountingReader(fileobj)
+    start = time.perf_counter()
+    try:
+        with ipfs_client("add") as client:
+            ipfs_hash = client.add(stream)["Hash"]
+    except ipfshttpclient.exceptions.ErrorResponse as e:
+        return {"error": str(e)}, 500
+    UPLOAD_BYTES.inc(stream.size)
+    UPLOAD_THROUGHPUT.observe(stream.size / (time.perf_counter() - start))
+
+    # already pinned
+    ipfs = db.session.query(Ipfs).filter(Ipfs.pin_hash == ipfs_hash).first()
+    if ipfs and not ipfs.date_unpinned:
+        return _pin_file_response(ipfs)
+
+    # actually pin this time
+    try:
+        with ipfs_client("pin.add") as client:
+            client.pin.add(ipfs_hash)
+    except ipfshttpclient.exceptions.ErrorResponse as e:
+        return {"error": str(e)}, 500
+
+    # add to database, or mark as pinned again if it was unpinned
+    md = {"name": name, "size": stream.size, "keyvalues": keyvalues}
+    if ipfs:
+        return _pin_file_response(_repin_in_db(ipfs, md, g.api_key.user_id))
+    try:
+        ipfs = _add_to_db(ipfs_hash, md, g.api_key.user_id)
+    except IntegrityError as _:
+        # the same file was uploaded concurrently
+        ipfs = db.session.query(Ipfs).filter(Ipfs.pin_hash == ipfs_hash).one()
+
+    # success -- yes: this is a different case to pinByHash...
+    return _pin_file_response(ipfs)
+
+
 @app.route("/pinning/pinFileToIPFS", methods=["POST"])
 @api_key_required
 def pin_file_to_ipfs() -> Any:
@@ -195,112 +748,305 @@ def pin_file_to_ipfs() -> Any:
         keyvalues = json.loads(fileitem.headers["keyvalues"].replace("'", '"'))
     except KeyError as _:
         pass
-    try:
-        for country_code in keyvalues["bannedCountryCodes"]:
-            if country_code not in app.config["BANNED_COUNTRY_CODES"]:
-                return {
-                    "Error": "country code {} is not included in server "
-                    "BANNED_COUNTRY_CODES=[{}]".format(
-                        country_code, ",".join(app.config["BANNED_COUNTRY_CODES"])
-                    )
-                }, 400
-    except KeyError as _:
-        pass
+    error = _check_banned_country_codes(keyvalues)
+    if error:
+        return {"Error": error}, 400
 
-    # proxy
-    blob = fileitem.read()
-    try:
-        with ipfshttpclient.connect() as client:
-            ipfs_hash = client.add_bytes(blob)
-    except ipfshttpclient.exceptions.ErrorResponse as e:
-        return {"error": str(e)}, 500
+    # get the name, preferring the one in the metadata
+    name = fileitem.headers.get("name", fileitem.filename)
+    return _pin_stream(fileitem.stream, name, keyvalues)
+
+
+@app.route("/ipfs/<ipfs_hash>", methods=["GET"])
+def gateway(ipfs_hash: str) -> Any:
+    """Download a pinned object.
+
+    Objects with a ``bannedCountryCodes`` attribute are not served to clients
+    in those countries, when the GeoIP index is configured.
+    """
 
     # find in database
     ipfs = db.session.query(Ipfs).filter(Ipfs.pin_hash == ipfs_hash).first()
-    if ipfs:
-        return {
-            "IpfsHash": ipfs_hash,
-            "PinSize": ipfs.size,
-            "Name": ipfs.name,
-            "Timestamp": ipfs.date_pinned.isoformat(),
-        }
+    if not ipfs or ipfs.date_unpinned:
+        return {"error": "Not pinned: {}".format(ipfs_hash)}, 404
+    attr = ipfs.attr("bannedCountryCodes")
+    if is_banned(attr.value if attr else None):
+        return {"error": "Not available in this country"}, 451
 
-    # actually pin this time
+    # proxy, streaming from the daemon a chunk at a time
     try:
-        with ipfshttpclient.connect() as client:
-            client.pin.add(ipfs_hash)
-    except ipfshttpclient.exceptions.ErrorResponse as e:
+        chunks = ipfs_cat(ipfs_hash)
+    except ipfshttpclient.exceptions.Error as e:
         return {"error": str(e)}, 500
+    return Response(stream_with_context(chunks), mimetype="application/octet-stream")
+
 
-    # add to database
-    md = {}
-    md["name"] = fileitem.filename
-    md["size"] = len(blob)
-    md["keyvalues"] = keyvalues
+@app.route("/pinJobs", methods=["GET"])
+@api_key_required
+def pin_jobs() -> Any:
+    """ return pending jobs """
+
+    stmt = db.session.query(PinJob)
+    if not g.api_key.admin:
+        stmt = stmt.filter(PinJob.user_id == g.api_key.user_id)
+    if "status" in request.args:
+        stmt = stmt.filter(PinJob.status == request.args["status"])
+    if "ipfs_pin_hash" in request.args:
+        stmt = stmt.filter(PinJob.pin_hash == request.args["ipfs_pin_hash"])
     try:
-        md["name"] = fileitem.headers["name"]
-    except KeyError as _:
-        pass
-    _add_to_db(ipfs_hash, md)
+        limit = min(int(request.args.get("limit", 5)), 1000)
+        offset = int(request.args.get("offset", 0))
+        sort = request.args.get("sort", "ASC").upper()
+        if sort not in ["ASC", "DESC"]:
+            raise ValueError("unknown sort {}".format(sort))
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    count = stmt.count()
+    if sort == "ASC":
+        stmt = stmt.order_by(PinJob.date_queued.asc(), PinJob.pin_job_id.asc())
+    else:
+        stmt = stmt.order_by(PinJob.date_queued.desc(), PinJob.pin_job_id.desc())
 
-    # success -- yes: this is a different case to pinByHash...
+    rows = []
+    for job in stmt.offset(offset).limit(limit):
+        rows.append(
+            {
+                "id": job.pin_job_id,
+                "ipfs_pin_hash": job.pin_hash,
+                "date_queued": job.date_queued.isoformat(),
+                "name": job.name,
+                "status": job.status,
+                "keyvalues": job.metadata_dict.get("keyvalues"),
+                "host_nodes": [],
+                "pin_policy": {
+                    "regions": [{"id": "0", "desiredReplicationCount": 1}],
+                    "version": 1,
+                },
+            }
+        )
+    return {"count": count, "rows": rows}
+
+
+# the IPFS hash of the content is immutable, so this never needs a TTL
+_json_digest_cache = LruCache(app.config.get("JSON_DIGEST_CACHE_SIZE", 100000))
+
+
+def _json_digest_lookup(digest: str) -> Optional[str]:
+    """ find the IPFS hash of previously added JSON content by its digest """
+    pin_hash = _json_digest_cache.get(digest)
+    if pin_hash:
+        JSON_DIGEST_LOOKUPS.labels("memory").inc()
+        return pin_hash
+    row = db.session.query(JsonDigest).filter(JsonDigest.digest == digest).first()
+    if not row:
+        JSON_DIGEST_LOOKUPS.labels("miss").inc()
+        return None
+    JSON_DIGEST_LOOKUPS.labels("database").inc()
+    _json_digest_cache.set(digest, row.pin_hash)
+    return row.pin_hash
+
+
+def _json_digest_add(digest: str, pin_hash: str) -> None:
+    """ remember the IPFS hash of some added JSON content """
+    stmt = postgresql.insert(JsonDigest.__table__).values(
+        digest=digest, pin_hash=pin_hash, date_created=datetime.datetime.utcnow()
+    )
+    db.session.execute(stmt.on_conflict_do_nothing())
+    db.session.commit()
+    _json_digest_cache.set(digest, pin_hash)
+
+
+def _pin_json_response(ipfs: Ipfs, is_duplicate: bool) -> Dict[str, Any]:
+    """ get the pinJSONToIPFS JSON for a given Ipfs object """
     return {
-        "IpfsHash": ipfs_hash,
-        "PinSize": ipfs.size,
+        "IpfsHash": ipfs.pin_hash,
+        "PinSize": ipfs.size or 0,
         "Timestamp": ipfs.date_pinned.isoformat(),
+        "isDuplicate": is_duplicate,
     }
 
 
-@app.route("/pinJobs", methods=["GET"])
-@api_key_required
-def pin_jobs() -> Any:
-    """ FIXME: return pending jobs """
-    return {}, 404
-
-
 @app.route("/pinning/pinJSONToIPFS", methods=["POST"])
 @api_key_required
 def pin_json_to_ipfs() -> Any:
-    """ FIXME: pin a JSON blob to the IPFS """
-
-    # {
-    #    pinataMetadata: {
-    #        name: 'ItemStatus'
-    #        keyvalues: {
-    #            ItemID: 'Item001',
-    #        }
-    #    },
-    #    pinataContent: {
-    #        inspectedBy: 'Inspector001',
-    #    }
-    # }
+    """Pin a JSON blob to the IPFS.
 
-    return {}, 404
+    The ``pinataContent`` is serialized canonically, with sorted keys and no
+    whitespace, so that content that has been pinned before can be found from
+    its SHA-256 digest without adding it to the daemon again.
+    """
+
+    # get content
+    try:
+        payload = json.loads(request.data.decode("utf8"))
+        content = payload["pinataContent"]
+    except KeyError as e:
+        return {"error": str(e)}, 500
+    md = payload.get("pinataMetadata") or {}
+    keyvalues = md.get("keyvalues") or {}
+    error = _check_banned_country_codes(keyvalues)
+    if error:
+        return {"Error": error}, 400
+    data = json.dumps(
+        content, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    ).encode("utf8")
+    digest = hashlib.sha256(data).hexdigest()
+
+    # already pinned, without asking the daemon
+    pin_hash = _json_digest_lookup(digest)
+    if pin_hash:
+        ipfs = db.session.query(Ipfs).filter(Ipfs.pin_hash == pin_hash).first()
+        if ipfs and not ipfs.date_unpinned:
+            return _pin_json_response(ipfs, is_duplicate=True)
+
+    # proxy
+    try:
+        with ipfs_client("add") as client:
+            ipfs_hash = client.add_bytes(data)
+    except ipfshttpclient.exceptions.ErrorResponse as e:
+        return {"error": str(e)}, 500
+    UPLOAD_BYTES.inc(len(data))
+
+    # already pinned some other way
+    ipfs = db.session.query(Ipfs).filter(Ipfs.pin_hash == ipfs_hash).first()
+    if ipfs and not ipfs.date_unpinned:
+        _json_digest_add(digest, ipfs_hash)
+        return _pin_json_response(ipfs, is_duplicate=True)
+
+    # actually pin this time
+    try:
+        with ipfs_client("pin.add") as client:
+            client.pin.add(ipfs_hash)
+    except ipfshttpclient.exceptions.ErrorResponse as e:
+        return {"error": str(e)}, 500
+
+    # add to database, or mark as pinned again if it was unpinned
+    md = {"name": md.get("name"), "size": len(data), "keyvalues": keyvalues}
+    try:
+        if ipfs:
+            ipfs = _repin_in_db(ipfs, md, g.api_key.user_id)
+        else:
+            ipfs = _add_to_db(ipfs_hash, md, g.api_key.user_id)
+    except IntegrityError as _:
+        # the same content was pinned concurrently
+        ipfs = db.session.query(Ipfs).filter(Ipfs.pin_hash == ipfs_hash).one()
+    _json_digest_add(digest, ipfs_hash)
+
+    # success
+    return _pin_json_response(ipfs, is_duplicate=False)
 
 
 @app.route("/pinning/unpin/<ipfs_hash>", methods=["DELETE"])
+@api_key_required
 def unpin(ipfs_hash: str) -> Any:
     """ unpin an object from the IPFS """
 
     # find in database
-    try:
-        ipfs = db.session.query(Ipfs).filter(Ipfs.pin_hash == ipfs_hash).one()
-    except NoResultFound as _:
+    ipfs = db.session.query(Ipfs).filter(Ipfs.pin_hash == ipfs_hash).first()
+    if not ipfs or not _is_owner(ipfs):
         return {"error": "Current user has not pinned hash: {}".format(ipfs_hash)}, 500
 
-    # proxy
-    try:
-        with ipfshttpclient.connect() as client:
-            client.pin.rm(ipfs_hash)
-    except ipfshttpclient.exceptions.ErrorResponse as e:
-        return {"error": str(e)}, 500
+    # proxy, unless the daemon has already unpinned it
+    if not ipfs.date_unpinned:
+        try:
+            with ipfs_client("pin.rm") as client:
+                client.pin.rm(ipfs_hash)
+        except ipfshttpclient.exceptions.ErrorResponse as e:
+            return {"error": str(e)}, 500
+        _update_usage({ipfs.user_id: (-1, -(ipfs.size or 0))})
 
     # success
     db.session.delete(ipfs)
+    _bump_changes("unpins")
+    _bump_changes()
     db.session.commit()
     return "OK", 200
 
 
+def _unpin_from_daemon(ipfs_hash: str) -> Optional[str]:
+    """ unpin a hash from the daemon, returning the error if any """
+    try:
+        with ipfs_client("pin.rm") as client:
+            client.pin.rm(ipfs_hash)
+    except ipfshttpclient.exceptions.Error as e:
+        return str(e)
+    return None
+
+
+@app.route("/pinning/unpinBatch", methods=["POST"])
+@api_key_required
+def unpin_batch() -> Any:
+    """Unpin several objects from the IPFS.
+
+    The daemon calls are made with a bounded concurrency and the database
+    rows of the successfully unpinned objects are deleted in one transaction.
+    Each hash is only unpinned and returned once, even if repeated.
+    """
+
+    try:
+        ipfs_hashes = list(dict.fromkeys(_batch_payload("hashes")))
+    except (KeyError, TypeError, ValueError) as e:
+        return {"error": str(e)}, 400
+
+    # find in database
+    ipfs_for_hash = {
+        ipfs_hash: ipfs
+        for ipfs_hash, ipfs in _ipfs_for_hashes(ipfs_hashes).items()
+        if _is_owner(ipfs)
+    }
+    pinned = [ipfs_hash for ipfs_hash in ipfs_hashes if ipfs_hash in ipfs_for_hash]
+
+    # proxy, skipping any the daemon has already unpinned
+    on_daemon = [
+        ipfs_hash for ipfs_hash in pinned if not ipfs_for_hash[ipfs_hash].date_unpinned
+    ]
+    errors: Dict[str, Optional[str]] = dict.fromkeys(pinned)
+    with ThreadPoolExecutor(
+        max_workers=app.config.get("BATCH_CONCURRENCY", 8)
+    ) as executor:
+        errors.update(zip(on_daemon, executor.map(_unpin_from_daemon, on_daemon)))
+
+    # delete everything unpinned in one transaction
+    ipfs_ids: List[int] = []
+    deltas: Dict[str, Tuple[int, int]] = {}
+    for ipfs_hash in pinned:
+        if errors[ipfs_hash]:
+            continue
+        ipfs = ipfs_for_hash[ipfs_hash]
+        ipfs_ids.append(ipfs.ipfs_id)
+        if not ipfs.date_unpinned:
+            count, size = deltas.get(ipfs.user_id, (0, 0))
+            deltas[ipfs.user_id] = (count - 1, size - (ipfs.size or 0))
+    _update_usage(deltas)
+    chunk_size = app.config.get("SQL_IN_CHUNK_SIZE", 5000)
+    for i in range(0, len(ipfs_ids), chunk_size):
+        db.session.query(IpfsAttr).filter(
+            IpfsAttr.ipfs_id.in_(ipfs_ids[i : i + chunk_size])
+        ).delete(synchronize_session=False)
+        db.session.query(Ipfs).filter(
+            Ipfs.ipfs_id.in_(ipfs_ids[i : i + chunk_size])
+        ).delete(synchronize_session=False)
+    if ipfs_ids:
+        _bump_changes("unpins", len(ipfs_ids))
+        _bump_changes()
+    db.session.commit()
+
+    rows = []
+    for ipfs_hash in ipfs_hashes:
+        if ipfs_hash not in ipfs_for_hash:
+            rows.append(
+                {
+                    "ipfsHash": ipfs_hash,
+                    "error": "Current user has not pinned hash: {}".format(ipfs_hash),
+                }
+            )
+        elif errors[ipfs_hash]:
+            rows.append({"ipfsHash": ipfs_hash, "error": errors[ipfs_hash]})
+        else:
+            rows.append({"ipfsHash": ipfs_hash, "status": "OK"})
+    return {"count": len(rows), "rows": rows}
+
+
 @app.route("/pinning/userPinPolicy", methods=["PUT"])
 @api_key_required
 def user_pin_policy() -> Any:
@@ -312,58 +1058,276 @@ def user_pin_policy() -> Any:
 def _get_metadata(ipfs: Ipfs) -> Dict[str, Any]:
     """ get the metadata JSON for a given Ipfs object """
     keyvalues: Dict[str, Any] = {}
-    for attr in ipfs.attrs:
-        keyvalues[attr.key] = attr.value
+    for key, attr in ipfs.attrs.items():
+        keyvalues[key] = attr.value
     return {"name": ipfs.name, "keyvalues": keyvalues}
 
 
+def _pin_row(ipfs: Ipfs) -> Dict[str, Any]:
+    """ get the pinList JSON for a given Ipfs object """
+    return {
+        "id": ipfs.ipfs_id,
+        "ipfs_pin_hash": ipfs.pin_hash,
+        "size": ipfs.size or 0,
+        "size_pending": ipfs.size is None,
+        "user_id": ipfs.user_id,
+        "date_pinned": ipfs.date_pinned.isoformat(),
+        "date_unpinned": ipfs.date_unpinned.isoformat() if ipfs.date_unpinned else None,
+        "metadata": _get_metadata(ipfs),
+        "regions": [
+            {
+                "regionId": 0,
+                "desiredReplicationCount": 1,
+                "currentReplicationCount": 1,
+            }
+        ],
+    }
+
+
+def _parse_datetime(value: str) -> datetime.datetime:
+    """ parse an ISO 8601 timestamp into a naive UTC datetime """
+    dt = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def _keyvalue_filter(key: str, query: Dict[str, Any]) -> Any:
+    """ get the SQL filter for a Pinata metadata[keyvalues] query """
+    value = query["value"]
+    op = query.get("op", "eq")
+    column: Any = IpfsAttr.value
+    if op == "eq":
+        condition = column == str(value)
+    elif op == "ne":
+        condition = column != str(value)
+    elif op == "gt":
+        condition = column > str(value)
+    elif op == "gte":
+        condition = column >= str(value)
+    elif op == "lt":
+        condition = column < str(value)
+    elif op == "lte":
+        condition = column <= str(value)
+    elif op == "between":
+        condition = column.between(str(value), str(query["secondValue"]))
+    elif op == "notBetween":
+        condition = ~column.between(str(value), str(query["secondValue"]))
+    elif op == "like":
+        condition = column.like(str(value))
+    elif op == "notLike":
+        condition = ~column.like(str(value))
+    elif op == "iLike":
+        condition = column.ilike(str(value))
+    elif op == "notILike":
+        condition = ~column.ilike(str(value))
+    elif op == "regexp":
+        condition = column.op("~")(str(value))
+    elif op == "iRegexp":
+        condition = column.op("~*")(str(value))
+    else:
+        raise ValueError("unknown keyvalues op {}".format(op))
+    attrs: Any = Ipfs.attrs
+    return attrs.any(and_(IpfsAttr.key == key, condition))
+
+
+def _pin_list_query(args: Any) -> Any:
+    """ build the filtered Ipfs query for the Pinata pinList parameters """
+    stmt = db.session.query(Ipfs)
+    if not g.api_key.admin:
+        stmt = stmt.filter(Ipfs.user_id == g.api_key.user_id)
+
+    # objects unpinned using the API are deleted, but reconciliation with the
+    # daemon marks objects that have been unpinned some other way
+    status = args.get("status", "all")
+    if status == "pinned":
+        stmt = stmt.filter(Ipfs.date_unpinned == None)
+    elif status == "unpinned":
+        stmt = stmt.filter(Ipfs.date_unpinned != None)
+    elif status != "all":
+        raise ValueError("unknown status {}".format(status))
+
+    if "hashContains" in args:
+        stmt = stmt.filter(Ipfs.pin_hash.contains(args["hashContains"]))
+    if "pinStart" in args:
+        stmt = stmt.filter(Ipfs.date_pinned >= _parse_datetime(args["pinStart"]))
+    if "pinEnd" in args:
+        stmt = stmt.filter(Ipfs.date_pinned <= _parse_datetime(args["pinEnd"]))
+    size: Any = Ipfs.size
+    if "pinSizeMin" in args:
+        stmt = stmt.filter(size >= int(args["pinSizeMin"]))
+    if "pinSizeMax" in args:
+        stmt = stmt.filter(size <= int(args["pinSizeMax"]))
+    if "metadata[name]" in args:
+        name: Any = Ipfs.name
+        stmt = stmt.filter(name.ilike("%{}%".format(args["metadata[name]"])))
+    if "metadata[keyvalues]" in args:
+        keyvalues = json.loads(args["metadata[keyvalues]"])
+        for key in keyvalues:
+            stmt = stmt.filter(_keyvalue_filter(key, keyvalues[key]))
+    return stmt
+
+
+def _wants_ndjson() -> bool:
+    """ check if the client asked for the rows as newline delimited JSON """
+    if request.args.get("format") == "ndjson":
+        return True
+    return (
+        request.accept_mimetypes.best_match(
+            ["application/json", "application/x-ndjson"]
+        )
+        == "application/x-ndjson"
+    )
+
+
+def _pin_list_ndjson(stmt: Any, page_limit: Optional[int]) -> Response:
+    """Stream the rows of the query as newline delimited JSON.
+
+    The rows are fetched from a server side cursor a batch at a time, so the
+    memory used does not depend on the number of pins.
+    """
+    batch_size = app.config.get("PIN_LIST_YIELD_PER", 1000)
+    stmt = stmt.options(selectinload(Ipfs.attrs))
+    if page_limit is not None:
+        stmt = stmt.limit(page_limit)
+
+    def _generate() -> Iterator[str]:
+        lines: List[str] = []
+        for ipfs in stmt.yield_per(batch_size):
+            lines.append(json.dumps(_pin_row(ipfs)))
+            if len(lines) >= batch_size:
+                yield "\n".join(lines) + "\n"
+                lines.clear()
+        if lines:
+            yield "\n".join(lines) + "\n"
+
+    return Response(stream_with_context(_generate()), mimetype="application/x-ndjson")
+
+
 @app.route("/data/pinList", methods=["GET"])
 @api_key_required
 def pin_list() -> Any:
-    """ gets the list of pins for this server """
+    """Gets the list of pins for this user, or for every user for admin keys.
 
-    # proxy
+    The rows are served from the database alone, which is kept in sync with
+    the daemon pin set by ``flask worker`` or ``flask reconcile``.
+
+    As well as the Pinata filters, a ``pageAfter`` parameter of the last
+    seen ``id`` can be used instead of ``pageOffset`` to fetch deep pages
+    without the database having to skip over all the previous rows.
+
+    With ``Accept: application/x-ndjson`` or ``format=ndjson`` the rows are
+    streamed one per line without a count, and every matching row is
+    returned unless ``pageLimit`` is given.
+
+    Responses have an ETag, and a 304 is returned when nothing has changed.
+
+    The size of objects pinned by hash is resolved in the background, and
+    until then is 0 with ``size_pending`` set.
+    """
+
+    ndjson = _wants_ndjson()
+    return _conditional_response(
+        lambda: _pin_list(ndjson), "ndjson" if ndjson else "json"
+    )
+
+
+def _pin_list(ndjson: bool) -> Any:
+    """ get the pinList response for the request """
+
+    # build query
     try:
-        with ipfshttpclient.connect() as client:
-            keys = client.pin.ls()["Keys"]
-    except KeyError as e:
-        return {"error": str(e)}, 500
+        stmt = _pin_list_query(request.args)
+        if ndjson and "pageLimit" not in request.args:
+            page_limit = None
+        else:
+            page_limit = min(int(request.args.get("pageLimit", 10)), 1000)
+        page_offset = int(request.args.get("pageOffset", 0))
+        page_after = request.args.get("pageAfter", type=int)
+        sort_order = request.args.get("sortOrder", "DESC").upper()
+        if sort_order not in ["ASC", "DESC"]:
+            raise ValueError("unknown sortOrder {}".format(sort_order))
+    except (ValueError, KeyError, TypeError) as e:
+        return {"error": str(e)}, 400
+    count = stmt.count() if not ndjson else None
+    if sort_order == "ASC":
+        if page_after is not None:
+            stmt = stmt.filter(Ipfs.ipfs_id > page_after)
+        stmt = stmt.order_by(Ipfs.ipfs_id.asc())
+    else:
+        if page_after is not None:
+            stmt = stmt.filter(Ipfs.ipfs_id < page_after)
+        stmt = stmt.order_by(Ipfs.ipfs_id.desc())
+    if page_after is None:
+        stmt = stmt.offset(page_offset)
+    if ndjson:
+        return _pin_list_ndjson(stmt, page_limit)
+    rows = [_pin_row(ipfs) for ipfs in stmt.limit(page_limit)]
+    return {"count": count, "rows": rows}
+
+
+@app.route("/data/userPinnedDataTotal", methods=["GET"])
+@api_key_required
+def user_pinned_data_total() -> Any:
+    """ get the number and total size of the objects pinned by this user """
+    return _conditional_response(_user_pinned_data_total)
+
+
+def _user_pinned_data_total() -> Any:
+    usage = (
+        db.session.query(UserUsage)
+        .filter(UserUsage.user_id == g.api_key.user_id)
+        .first()
+    )
+    pin_count = usage.pin_count if usage else 0
+    pin_size = usage.pin_size if usage else 0
+    return {
+        "pin_count": pin_count,
+        "pin_size_total": pin_size,
+        "pin_size_with_replications_total": pin_size,
+    }
 
-    rows = []
-    for ipfs_hash in keys:
-        if keys[ipfs_hash]["Type"] == "indirect":
-            continue
 
-        # find in database
-        ipfs = db.session.query(Ipfs).filter(Ipfs.pin_hash == ipfs_hash).first()
-        if not ipfs:
-            continue
-        rows.append(
-            {
-                "id": ipfs.ipfs_id,
-                "ipfs_pin_hash": ipfs_hash,
-                "size": ipfs.size,
-                "user_id": app.config["ADMIN_EMAIL"],
-                "date_pinned": ipfs.date_pinned.isoformat(),
-                "date_unpinned": None,
-                "metadata": _get_metadata(ipfs),
-                "regions": [
-                    {
-                        "regionId": 0,
-                        "desiredReplicationCount": 1,
-                        "currentReplicationCount": 1,
-                    }
-                ],
-            }
-        )
+def _publish_row(job: IpnsPublish) -> Dict[str, Any]:
+    """ get the publish job JSON for a given IpnsPublish object """
+    return {
+        "id": job.ipns_publish_id,
+        "key": job.key,
+        "ipfsHash": job.pin_hash,
+        "status": job.status,
+        "error": job.error,
+        "IpnsHash": job.ipns_hash,
+        "publishedHash": job.published_hash,
+        "date_published": job.date_published.isoformat()
+        if job.date_published
+        else None,
+    }
 
-    return {"count": len(rows), "rows": rows}
+
+def _ipns_name(key: str) -> Optional[str]:
+    """ get the IPNS name that records are published to for a key """
+    with ipfs_client("key.list") as client:
+        for item in client.key.list()["Keys"]:
+            if item["Name"] == key:
+                return item["Id"]
+    return None
 
 
 @app.route("/publishing/publishByHash", methods=["POST"])
 @api_key_required
+@admin_required
 def publish_by_hash() -> Any:
-    """ publish an existing IPFS object using IPNS """
+    """Publish an existing IPFS object using IPNS.
+
+    Publishing to the DHT is slow, so the publish is queued and processed by
+    ``flask worker``. Any publish for the same key that has not yet started
+    is replaced by this one. An optional Stomata-specific ``key`` sets the
+    IPNS key to publish with, which is ``self`` by default. The keys belong to
+    the node rather than to a user, so only admin API keys can publish.
+
+    The ``IpnsHash`` is known before the record is published, as it is the
+    ID of the key, and is returned along with the job ``id`` to poll.
+    """
 
     # get ipfs hash
     try:
@@ -371,19 +1335,76 @@ def publish_by_hash() -> Any:
         ipfs_hash = payload["hashToPublish"]
     except KeyError as e:
         return {"error": str(e)}, 500
+    key = payload.get("key", "self")
 
     # find in database
     try:
-        _ = db.session.query(Ipfs).filter(Ipfs.pin_hash == ipfs_hash).one()
+        ipfs = db.session.query(Ipfs).filter(Ipfs.pin_hash == ipfs_hash).one()
     except NoResultFound as e:
         return {"error": str(e)}, 500
+    if not _is_owner(ipfs):
+        return {"error": "Current user has not pinned hash: {}".format(ipfs_hash)}, 500
 
-    # proxy
+    # resolve the IPNS name from the node key
     try:
-        with ipfshttpclient.connect() as client:
-            ipnshash = client.name.publish(ipfs_hash)["Name"]
-    except KeyError as e:
+        ipns_hash = _ipns_name(key)
+    except ipfshttpclient.exceptions.Error as e:
         return {"error": str(e)}, 500
+    if not ipns_hash:
+        return {"error": "No IPNS key: {}".format(key)}, 400
+
+    # add to queue, replacing any publish for this key that has not started;
+    # a publish in progress keeps its lease and is requeued by the worker
+    now = datetime.datetime.utcnow()
+    stmt = postgresql.insert(IpnsPublish.__table__).values(
+        key=key,
+        pin_hash=ipfs_hash,
+        ipns_hash=ipns_hash,
+        status="queued",
+        attempts=0,
+        date_queued=now,
+        date_next_attempt=now,
+    )
+    table = IpnsPublish.__table__
+    publishing = table.c.status == "publishing"
+    db.session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[table.c.key],
+            set_={
+                "pin_hash": stmt.excluded.pin_hash,
+                "ipns_hash": stmt.excluded.ipns_hash,
+                "attempts": 0,
+                "error": None,
+                "date_queued": stmt.excluded.date_queued,
+                "status": case(
+                    [(publishing, table.c.status)], else_=stmt.excluded.status
+                ),
+                "date_next_attempt": case(
+                    [(publishing, table.c.date_next_attempt)],
+                    else_=stmt.excluded.date_next_attempt,
+                ),
+            },
+        )
+    )
+    db.session.commit()
+    job = db.session.query(IpnsPublish).filter(IpnsPublish.key == key).one()
 
     # success
-    return {"IpnsHash": ipnshash}
+    return _publish_row(job)
+
+
+@app.route("/publishing/publishJobs/<int:ipns_publish_id>", methods=["GET"])
+@api_key_required
+@admin_required
+def publish_job(ipns_publish_id: int) -> Any:
+    """ get the status of an IPNS publish, which only admins can queue """
+
+    try:
+        job = (
+            db.session.query(IpnsPublish)
+            .filter(IpnsPublish.ipns_publish_id == ipns_publish_id)
+            .one()
+        )
+    except NoResultFound as e:
+        return {"error": str(e)}, 404
+    return _publish_row(job)
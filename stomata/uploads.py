@@ -0,0 +1,309 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+#
+# pylint: disable=invalid-name,singleton-comparison,no-member,cyclic-import
+
+"""Resumable uploads.
+
+A large file is uploaded by creating a session, PUTting chunks of the file at
+any offset, in any order and in parallel, and then finalizing the session
+which adds the spooled file to the IPFS exactly as ``pinFileToIPFS`` does.
+"""
+
+import os
+import json
+import tempfile
+import hashlib
+import datetime
+from typing import Any, Dict, List
+
+from flask import g, request
+from sqlalchemy.dialects import postgresql
+
+from stomata import app, db
+from .models import UploadChunk, UploadSession
+from .routes import api_key_required, _check_banned_country_codes, _pin_stream
+
+
+def _upload_path(upload: UploadSession) -> str:
+    """ get the filename the upload is spooled to """
+    return os.path.join(
+        app.config.get("UPLOAD_SESSION_DIR") or tempfile.gettempdir(),
+        "stomata-upload-{}".format(upload.upload_session_id),
+    )
+
+
+def _upload_row(upload: UploadSession) -> Dict[str, Any]:
+    """ get the JSON for a given UploadSession object """
+    return {
+        "id": upload.upload_session_id,
+        "name": upload.name,
+        "size": upload.size,
+        "offset": upload.offset,
+        "status": upload.status,
+        "chunks": [
+            {"offset": chunk.offset, "length": chunk.length} for chunk in upload.chunks
+        ],
+        "date_created": upload.date_created.isoformat(),
+    }
+
+
+def _get_upload(upload_session_id: int) -> Any:
+    """ get an upload session belonging to this user """
+    return (
+        db.session.query(UploadSession)
+        .filter(UploadSession.upload_session_id == upload_session_id)
+        .filter(UploadSession.user_id == g.api_key.user_id)
+        .first()
+    )
+
+
+def _remove_upload(upload: UploadSession) -> None:
+    """ delete an upload session and the spooled file """
+    try:
+        os.unlink(_upload_path(upload))
+    except FileNotFoundError as _:
+        pass
+    db.session.delete(upload)
+
+
+@app.route("/pinning/uploads", methods=["POST"])
+@api_key_required
+def upload_create() -> Any:
+    """Create a resumable upload.
+
+    The ``size`` of the file in bytes is required, and ``pinataMetadata`` is
+    the same as for ``pinJSONToIPFS``.
+    """
+
+    try:
+        payload = json.loads(request.data.decode("utf8"))
+        size = int(payload["size"])
+    except (KeyError, TypeError, ValueError) as e:
+        return {"error": str(e)}, 400
+    if size < 0 or size > app.config.get("UPLOAD_SESSION_MAX_SIZE", 0x1000000000):
+        return {"error": "invalid size {}".format(size)}, 400
+    md = payload.get("pinataMetadata") or {}
+    error = _check_banned_country_codes(md.get("keyvalues") or {})
+    if error:
+        return {"Error": error}, 400
+
+    upload = UploadSession(
+        user_id=g.api_key.user_id,
+        name=md.get("name"),
+        md=json.dumps(md),
+        size=size,
+    )
+    db.session.add(upload)
+    db.session.commit()
+
+    # reserve the space up front, so chunks can be written at any offset
+    with open(_upload_path(upload), "wb") as f:
+        f.truncate(size)
+
+    # success
+    return _upload_row(upload)
+
+
+@app.route("/pinning/uploads/<int:upload_session_id>", methods=["GET"])
+@api_key_required
+def upload_status(upload_session_id: int) -> Any:
+    """ get the offset and received chunks of a resumable upload """
+
+    upload = _get_upload(upload_session_id)
+    if not upload:
+        return {"error": "No upload {}".format(upload_session_id)}, 404
+    return _upload_row(upload)
+
+
+@app.route("/pinning/uploads/<int:upload_session_id>", methods=["PUT"])
+@api_key_required
+def upload_chunk(upload_session_id: int) -> Any:
+    """Upload a chunk of a resumable upload.
+
+    The ``Upload-Offset`` header is the offset of the chunk in the file and
+    the ``Upload-Checksum`` header is ``sha256`` and the hex digest of the
+    chunk. The chunk is only written to the spooled file once it has been
+    checked, so a chunk that does not match the checksum does not change the
+    file or what is recorded, and can be uploaded again.
+    """
+
+    try:
+        offset = int(request.headers["Upload-Offset"])
+        algorithm, checksum = request.headers["Upload-Checksum"].split(" ", 1)
+        length = int(request.headers["Content-Length"])
+    except (KeyError, ValueError) as e:
+        return {"error": str(e)}, 400
+    if algorithm != "sha256":
+        return {"error": "unsupported checksum {}".format(algorithm)}, 400
+    upload = _get_upload(upload_session_id)
+    if not upload:
+        return {"error": "No upload {}".format(upload_session_id)}, 404
+    if upload.status != "uploading":
+        return {"error": "Upload is {}".format(upload.status)}, 409
+    if offset < 0 or offset + length > upload.size:
+        return {"error": "chunk is outside the upload"}, 400
+
+    # receive and check the chunk before it can overwrite anything
+    digest = hashlib.sha256()
+    received = 0
+    chunk_size = app.config.get("UPLOAD_CHUNK_SIZE", 0x10000)
+    with tempfile.SpooledTemporaryFile(
+        max_size=app.config.get("UPLOAD_BUFFER_SIZE", 0x100000)
+    ) as tmp:
+        while received < length:
+            buf = request.stream.read(min(chunk_size, length - received))
+            if not buf:
+                break
+            tmp.write(buf)
+            digest.update(buf)
+            received += len(buf)
+        if received != length:
+            return {"error": "chunk is incomplete"}, 400
+        if digest.hexdigest() != checksum.strip().lower():
+            return {"error": "chunk does not match checksum"}, 400
+
+        # copy to the spooled file, which other chunks may be writing to
+        tmp.seek(0)
+        fd = os.open(_upload_path(upload), os.O_WRONLY)
+        try:
+            for i in range(0, length, chunk_size):
+                os.pwrite(fd, tmp.read(chunk_size), offset + i)
+        finally:
+            os.close(fd)
+
+    # record, replacing any earlier attempt at the same chunk
+    stmt = postgresql.insert(UploadChunk.__table__).values(
+        upload_session_id=upload.upload_session_id,
+        offset=offset,
+        length=length,
+        checksum=digest.hexdigest(),
+    )
+    db.session.execute(
+        stmt.on_conflict_do_update(
+            constraint="uq_upload_chunks_session_offset",
+            set_={"length": stmt.excluded.length, "checksum": stmt.excluded.checksum},
+        )
+    )
+    upload.date_updated = datetime.datetime.utcnow()
+    db.session.commit()
+
+    # success
+    return _upload_row(upload)
+
+
+def _bad_chunks(upload: UploadSession) -> List[UploadChunk]:
+    """ get the recorded chunks that no longer match their checksum """
+    chunk_size = app.config.get("UPLOAD_CHUNK_SIZE", 0x10000)
+    bad_chunks: List[UploadChunk] = []
+    with open(_upload_path(upload), "rb") as f:
+        for chunk in upload.chunks:
+            digest = hashlib.sha256()
+            f.seek(chunk.offset)
+            remaining = chunk.length
+            while remaining > 0:
+                buf = f.read(min(chunk_size, remaining))
+                if not buf:
+                    break
+                digest.update(buf)
+                remaining -= len(buf)
+            if remaining or digest.hexdigest() != chunk.checksum:
+                bad_chunks.append(chunk)
+    return bad_chunks
+
+
+@app.route("/pinning/uploads/<int:upload_session_id>/finalize", methods=["POST"])
+@api_key_required
+def upload_finalize(upload_session_id: int) -> Any:
+    """Add a complete resumable upload to the IPFS and pin it.
+
+    The response is the same as for ``pinFileToIPFS``. Every chunk is checked
+    again first, and any that have been overwritten with different data, for
+    instance by an overlapping chunk, are removed so they can be uploaded
+    again.
+    """
+
+    upload = _get_upload(upload_session_id)
+    if not upload:
+        return {"error": "No upload {}".format(upload_session_id)}, 404
+    if upload.offset < upload.size:
+        return {"error": "Upload is missing data from {}".format(upload.offset)}, 400
+
+    # only one request can finalize the upload
+    count = (
+        db.session.query(UploadSession)
+        .filter(UploadSession.upload_session_id == upload_session_id)
+        .filter(UploadSession.status == "uploading")
+        .update(
+            {
+                UploadSession.status: "finalizing",
+                UploadSession.date_updated: datetime.datetime.utcnow(),
+            },
+            synchronize_session=False,
+        )
+    )
+    db.session.commit()
+    if not count:
+        return {"error": "Upload is already being finalized"}, 409
+
+    # allow trying again if the daemon failed, or anything else went wrong
+    md = upload.metadata_dict
+    try:
+        bad_chunks = _bad_chunks(upload)
+        if bad_chunks:
+            for chunk in bad_chunks:
+                db.session.delete(chunk)
+            upload.status = "uploading"
+            db.session.commit()
+            return {
+                "error": "Upload is missing data from {}".format(upload.offset)
+            }, 400
+        with open(_upload_path(upload), "rb") as f:
+            response = _pin_stream(f, upload.name, md.get("keyvalues") or {})
+    except Exception:
+        db.session.rollback()
+        upload.status = "uploading"
+        db.session.commit()
+        raise
+    if isinstance(response, tuple):
+        upload.status = "uploading"
+        db.session.commit()
+        return response
+
+    # success
+    _remove_upload(upload)
+    db.session.commit()
+    return response
+
+
+@app.route("/pinning/uploads/<int:upload_session_id>", methods=["DELETE"])
+@api_key_required
+def upload_abort(upload_session_id: int) -> Any:
+    """ abandon a resumable upload """
+
+    upload = _get_upload(upload_session_id)
+    if not upload:
+        return {"error": "No upload {}".format(upload_session_id)}, 404
+    _remove_upload(upload)
+    db.session.commit()
+    return "OK", 200
+
+
+def expire_upload_sessions() -> int:
+    """ remove resumable uploads that have not been updated recently """
+    date_expired = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=app.config.get("UPLOAD_SESSION_TIMEOUT", 86400)
+    )
+    uploads = (
+        db.session.query(UploadSession)
+        .filter(UploadSession.date_updated < date_expired)
+        .all()
+    )
+    for upload in uploads:
+        _remove_upload(upload)
+    db.session.commit()
+    return len(uploads)
@@ -0,0 +1,610 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+#
+# pylint: disable=invalid-name,singleton-comparison,no-member,cyclic-import
+
+""" background processing of queued jobs """
+
+import time
+import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import ipfshttpclient
+
+from sqlalchemy import case
+from sqlalchemy.exc import IntegrityError
+
+from stomata import app, db
+from .daemon import ipfs_client
+from .metrics import GC_RECLAIMED_BYTES, GC_RUNS, IPFS_REPO_SIZE, PIN_SIZE_BACKLOG
+from .models import ChangeCounter, Ipfs, IpnsPublish, PinJob, UploadSession, UserUsage
+from .routes import (
+    _add_to_db,
+    _bump_changes,
+    _get_changes,
+    _repin_in_db,
+    _update_usage,
+)
+from .uploads import expire_upload_sessions
+
+
+class _JobRunner:
+    """ runs claimed jobs on a bounded number of threads """
+
+    def __init__(
+        self,
+        claim: Callable[[int], List[int]],
+        process: Callable[[int], None],
+        concurrency: int,
+    ) -> None:
+        self.claim = claim
+        self.process = process
+        self.concurrency = concurrency
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._futures: Set[Future] = set()
+
+    def _process(self, job_id: int) -> None:
+        with app.app_context():
+            try:
+                self.process(job_id)
+            except Exception as e:  # pylint: disable=broad-except
+                db.session.rollback()
+                app.logger.exception("failed to process job %i: %s", job_id, str(e))
+
+    def tick(self) -> bool:
+        """ claim jobs for any idle threads, returning True if any were found """
+        self._futures = {future for future in self._futures if not future.done()}
+        slots = self.concurrency - len(self._futures)
+        if slots <= 0:
+            return False
+        try:
+            job_ids = self.claim(slots)
+        except Exception as e:  # pylint: disable=broad-except
+            db.session.rollback()
+            app.logger.exception("failed to claim jobs: %s", str(e))
+            return False
+        for job_id in job_ids:
+            self._futures.add(self._executor.submit(self._process, job_id))
+        return len(job_ids) > 0
+
+
+class _PeriodicTask:
+    """ runs a function at most once every interval """
+
+    def __init__(self, func: Callable[[], Any], interval: float) -> None:
+        self.func = func
+        self.interval = interval
+        self._last_run: Optional[float] = None
+
+    def tick(self) -> None:
+        """ run the function if it is due """
+        now = time.monotonic()
+        if self._last_run is not None and now - self._last_run < self.interval:
+            return
+        self._last_run = now
+        try:
+            self.func()
+        except Exception as e:  # pylint: disable=broad-except
+            db.session.rollback()
+            app.logger.exception("failed to run %s: %s", self.func.__name__, str(e))
+
+
+def reconcile_pins() -> Dict[str, int]:
+    """Reconcile the Ipfs table with the recursive pins on the daemon.
+
+    Objects that are no longer pinned on the daemon are marked as unpinned,
+    and objects that have been pinned again are marked as pinned. Objects
+    added after the daemon was queried are ignored.
+    """
+    date_started = datetime.datetime.utcnow()
+    with ipfs_client("pin.ls") as client:
+        keys = set(client.pin.ls(type="recursive")["Keys"])
+
+    unpinned: List[int] = []
+    repinned: List[int] = []
+    tracked: Set[str] = set()
+    deltas: Dict[str, Tuple[int, int]] = {}
+    for ipfs_id, pin_hash, date_unpinned, user_id, size in (
+        db.session.query(
+            Ipfs.ipfs_id, Ipfs.pin_hash, Ipfs.date_unpinned, Ipfs.user_id, Ipfs.size
+        )
+        .filter(Ipfs.date_pinned < date_started)
+        .yield_per(10000)
+    ):
+        tracked.add(pin_hash)
+        if pin_hash in keys:
+            if not date_unpinned:
+                continue
+            repinned.append(ipfs_id)
+            sign = 1
+        elif not date_unpinned:
+            unpinned.append(ipfs_id)
+            sign = -1
+        else:
+            continue
+        count, total = deltas.get(user_id, (0, 0))
+        deltas[user_id] = (count + sign, total + sign * (size or 0))
+
+    chunk_size = 5000
+    for i in range(0, len(unpinned), chunk_size):
+        db.session.query(Ipfs).filter(
+            Ipfs.ipfs_id.in_(unpinned[i : i + chunk_size])
+        ).update({Ipfs.date_unpinned: date_started}, synchronize_session=False)
+    for i in range(0, len(repinned), chunk_size):
+        db.session.query(Ipfs).filter(
+            Ipfs.ipfs_id.in_(repinned[i : i + chunk_size])
+        ).update({Ipfs.date_unpinned: None}, synchronize_session=False)
+    _update_usage(deltas)
+    if unpinned:
+        _bump_changes("unpins", len(unpinned))
+    if unpinned or repinned:
+        _bump_changes()
+    db.session.commit()
+
+    report = {
+        "checked": len(tracked),
+        "unpinned": len(unpinned),
+        "repinned": len(repinned),
+        "untracked": len(keys - tracked),
+    }
+    app.logger.info(
+        "reconciled pins: %s",
+        ", ".join("{}={}".format(key, value) for key, value in report.items()),
+    )
+    return report
+
+
+def rebuild_usage() -> int:
+    """Rebuild the per-user usage counters from the ipfs table.
+
+    The counters are locked while rebuilding, so pins and unpins made at the
+    same time wait and are then added to the rebuilt totals.
+    """
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute("LOCK TABLE user_usage IN EXCLUSIVE MODE")
+    db.session.query(UserUsage).delete(synchronize_session=False)
+    size: Any = Ipfs.size
+    rows = (
+        db.session.query(
+            Ipfs.user_id, db.func.count(), db.func.coalesce(db.func.sum(size), 0)
+        )
+        .filter(Ipfs.date_unpinned == None)
+        .group_by(Ipfs.user_id)
+        .all()
+    )
+    for user_id, pin_count, pin_size in rows:
+        db.session.add(
+            UserUsage(user_id=user_id, pin_count=pin_count, pin_size=pin_size)
+        )
+    _bump_changes()
+    db.session.commit()
+    return len(rows)
+
+
+def _next_attempt(attempts: int) -> datetime.datetime:
+    """ get the time of the next attempt using exponential backoff """
+    backoff = app.config.get("PIN_JOB_BACKOFF", 60) * 2 ** (attempts - 1)
+    return datetime.datetime.utcnow() + datetime.timedelta(
+        seconds=min(backoff, app.config.get("PIN_JOB_BACKOFF_MAX", 3600))
+    )
+
+
+def _lease(timeout: float) -> datetime.timedelta:
+    """Get how long a claimed job is held before another worker can take it.
+
+    The lease covers waiting for a pooled client, the daemon call itself and
+    a margin for the commit afterwards, so a live worker never loses a job it
+    is still allowed to be processing.
+    """
+    return datetime.timedelta(
+        seconds=app.config.get("IPFS_POOL_TIMEOUT", 30)
+        + timeout
+        + app.config.get("WORKER_LEASE_MARGIN", 60)
+    )
+
+
+def _claim_pin_jobs(limit: int) -> List[int]:
+    """Claim pin jobs that are due.
+
+    Claimed jobs are leased for longer than PIN_JOB_TIMEOUT, so jobs held by
+    a worker that has died are picked up again.
+    """
+    now = datetime.datetime.utcnow()
+    jobs = (
+        db.session.query(PinJob)
+        .filter(PinJob.status.in_(["searching", "retrieving"]))
+        .filter(PinJob.date_next_attempt <= now)
+        .order_by(PinJob.date_next_attempt.asc())
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    for job in jobs:
+        job.status = "retrieving"
+        job.date_next_attempt = now + _lease(app.config.get("PIN_JOB_TIMEOUT", 600))
+    job_ids = [job.pin_job_id for job in jobs]
+    db.session.commit()
+    return job_ids
+
+
+def _process_pin_job(pin_job_id: int) -> None:
+    """ pin the object on the daemon and move it from the queue to Ipfs """
+
+    job = db.session.query(PinJob).filter(PinJob.pin_job_id == pin_job_id).one()
+    try:
+        with ipfs_client("pin.add") as client:
+            client.pin.add(job.pin_hash, timeout=app.config.get("PIN_JOB_TIMEOUT", 600))
+    except ipfshttpclient.exceptions.Error as e:
+        job.attempts += 1
+        job.error = str(e)
+        if job.attempts >= app.config.get("PIN_JOB_MAX_ATTEMPTS", 5):
+            job.status = "expired"
+        else:
+            job.status = "searching"
+            job.date_next_attempt = _next_attempt(job.attempts)
+        db.session.commit()
+        return
+
+    # the job is complete; if the hash was pinned another way just drop it
+    ipfs = db.session.query(Ipfs).filter(Ipfs.pin_hash == job.pin_hash).first()
+    if ipfs:
+        _repin_in_db(ipfs, job.metadata_dict, job.user_id)
+    else:
+        try:
+            _add_to_db(job.pin_hash, job.metadata_dict, job.user_id)
+        except IntegrityError as _:
+            pass
+    db.session.query(PinJob).filter(PinJob.pin_job_id == pin_job_id).delete()
+    db.session.commit()
+
+
+def _claim_ipns_publishes(limit: int) -> List[int]:
+    """ claim IPNS publishes that are due, leasing them as for pin jobs """
+    now = datetime.datetime.utcnow()
+    jobs = (
+        db.session.query(IpnsPublish)
+        .filter(IpnsPublish.status.in_(["queued", "publishing"]))
+        .filter(IpnsPublish.date_next_attempt <= now)
+        .order_by(IpnsPublish.date_next_attempt.asc())
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    for job in jobs:
+        job.status = "publishing"
+        job.date_next_attempt = now + _lease(
+            app.config.get("IPNS_PUBLISH_TIMEOUT", 300)
+        )
+    job_ids = [job.ipns_publish_id for job in jobs]
+    db.session.commit()
+    return job_ids
+
+
+def _process_ipns_publish(ipns_publish_id: int) -> None:
+    """Publish the newest hash for a key.
+
+    If a newer hash was queued while publishing then the row is requeued
+    rather than marked as published.
+    """
+    job = (
+        db.session.query(IpnsPublish)
+        .filter(IpnsPublish.ipns_publish_id == ipns_publish_id)
+        .one()
+    )
+    pin_hash = job.pin_hash
+    try:
+        with ipfs_client("name.publish") as client:
+            ipns_hash = client.name.publish(
+                pin_hash,
+                key=job.key,
+                lifetime=app.config.get("IPNS_RECORD_LIFETIME", "24h"),
+                timeout=app.config.get("IPNS_PUBLISH_TIMEOUT", 300),
+            )["Name"]
+    except ipfshttpclient.exceptions.Error as e:
+        db.session.refresh(job, with_for_update=True)
+        job.attempts += 1
+        job.error = str(e)
+        if job.pin_hash != pin_hash:
+            job.status = "queued"
+            job.attempts = 0
+            job.date_next_attempt = datetime.datetime.utcnow()
+        elif job.attempts >= app.config.get("IPNS_PUBLISH_MAX_ATTEMPTS", 5):
+            job.status = "failed"
+        else:
+            job.status = "queued"
+            job.date_next_attempt = _next_attempt(job.attempts)
+        db.session.commit()
+        return
+
+    # success, unless superseded while publishing
+    db.session.refresh(job, with_for_update=True)
+    job.ipns_hash = ipns_hash
+    job.published_hash = pin_hash
+    job.date_published = datetime.datetime.utcnow()
+    job.error = None
+    if job.pin_hash != pin_hash:
+        job.status = "queued"
+        job.attempts = 0
+        job.date_next_attempt = datetime.datetime.utcnow()
+    else:
+        job.status = "published"
+    db.session.commit()
+
+
+def refresh_ipns_records() -> None:
+    """ requeue published IPNS records before they expire """
+    date_expiring = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=app.config.get("IPNS_REFRESH_INTERVAL", 43200)
+    )
+    db.session.query(IpnsPublish).filter(IpnsPublish.status == "published").filter(
+        IpnsPublish.date_published < date_expiring
+    ).update(
+        {
+            IpnsPublish.status: "queued",
+            IpnsPublish.date_next_attempt: datetime.datetime.utcnow(),
+        },
+        synchronize_session=False,
+    )
+    db.session.commit()
+
+
+def _repo_size() -> Tuple[int, int]:
+    """ get the size of the IPFS repo and the maximum size it is configured for """
+    with ipfs_client("repo.stat") as client:
+        stat = client.repo.stat(opts={"size-only": "true"})
+    IPFS_REPO_SIZE.set(stat["RepoSize"])
+    return stat["RepoSize"], stat["StorageMax"]
+
+
+def collect_garbage(trigger: str = "manual") -> int:
+    """Remove unpinned objects from the IPFS repo, returning the bytes reclaimed.
+
+    The daemon cannot add or pin while collecting garbage, so this should only
+    be run when the pending unpins make it worthwhile. Unpins made while this
+    is running are collected the next time.
+    """
+    unpins = _get_changes("unpins")
+    start = time.monotonic()
+    size_before, _ = _repo_size()
+    with ipfs_client("repo.gc") as client:
+        client.repo.gc(
+            quiet=True,
+            return_result=False,
+            timeout=app.config.get("GC_TIMEOUT", 3600),
+        )
+    size_after, _ = _repo_size()
+    reclaimed = max(size_before - size_after, 0)
+    GC_RUNS.labels(trigger).inc()
+    GC_RECLAIMED_BYTES.inc(reclaimed)
+    db.session.merge(ChangeCounter(name="gc_unpins", value=unpins))
+    db.session.commit()
+    app.logger.info(
+        "collected garbage (%s) in %.1fs: reclaimed %i bytes, repo is %i bytes",
+        trigger,
+        time.monotonic() - start,
+        reclaimed,
+        size_after,
+    )
+    return reclaimed
+
+
+def _in_quiet_window() -> bool:
+    """ check if the local time is in GC_QUIET_WINDOW, e.g. ``02:00-05:00`` """
+    window = app.config.get("GC_QUIET_WINDOW")
+    if not window:
+        return False
+    start, end = [
+        datetime.time.fromisoformat(value.strip()) for value in window.split("-")
+    ]
+    now = datetime.datetime.now().time()
+    if start <= end:
+        return start <= now < end
+    return now >= start or now < end
+
+
+def _uploads_busy() -> bool:
+    """Check if the daemon is busy adding objects, so should not be paused.
+
+    Uploads and pin jobs that have outlived their lease belong to a worker
+    that has died, and so are not counted.
+    """
+    now = datetime.datetime.utcnow()
+    if (
+        db.session.query(UploadSession.upload_session_id)
+        .filter(UploadSession.status == "finalizing")
+        .filter(
+            UploadSession.date_updated
+            > now - _lease(app.config.get("IPFS_TIMEOUT", 120))
+        )
+        .first()
+        or db.session.query(PinJob.pin_job_id)
+        .filter(PinJob.status == "retrieving")
+        .filter(PinJob.date_next_attempt > now)
+        .first()
+    ):
+        return True
+    date_since = now - datetime.timedelta(
+        seconds=app.config.get("GC_UPLOAD_WINDOW", 600)
+    )
+    size: Any = Ipfs.size
+    uploaded = (
+        db.session.query(db.func.coalesce(db.func.sum(size), 0))
+        .filter(Ipfs.date_pinned >= date_since)
+        .scalar()
+    )
+    return uploaded > app.config.get("GC_UPLOAD_MAX_BYTES", 0x10000000)
+
+
+class _GarbageScheduler:
+    """Collects garbage once objects have been unpinned.
+
+    Unpins are batched up until the repo is over the GC_HIGH_WATERMARK
+    fraction of its maximum size, or until the GC_QUIET_WINDOW. Garbage is
+    not collected in the quiet window while there has been a lot uploaded
+    recently, but is always collected over the watermark as the daemon would
+    otherwise run out of space.
+    """
+
+    def __init__(self, min_interval: float) -> None:
+        self.min_interval = min_interval
+        self._last_run: Optional[float] = None
+
+    def tick(self) -> None:
+        """ collect garbage if it is due """
+        if (
+            self._last_run is not None
+            and time.monotonic() - self._last_run < self.min_interval
+        ):
+            return
+        pending = _get_changes("unpins") - _get_changes("gc_unpins")
+        if pending <= 0:
+            return
+        repo_size, storage_max = _repo_size()
+        if storage_max and repo_size >= storage_max * app.config.get(
+            "GC_HIGH_WATERMARK", 0.9
+        ):
+            trigger = "watermark"
+        elif _in_quiet_window():
+            if _uploads_busy():
+                app.logger.info("not collecting garbage while uploads are busy")
+                return
+            trigger = "quiet"
+        else:
+            return
+        self._last_run = time.monotonic()
+        collect_garbage(trigger)
+
+
+def _object_size(ipfs_hash: str) -> Optional[int]:
+    """ get the cumulative size of a pinned object, or None on error """
+    try:
+        with ipfs_client("object.stat") as client:
+            return client.object.stat(
+                ipfs_hash, timeout=app.config.get("SIZE_RESOLVE_TIMEOUT", 30)
+            )["CumulativeSize"]
+    except ipfshttpclient.exceptions.Error as e:
+        app.logger.warning("failed to get size of %s: %s", ipfs_hash, str(e))
+        return None
+
+
+def resolve_sizes(after_id: int = 0) -> Tuple[int, int]:
+    """Resolve the sizes of a batch of pinned objects with a pending size.
+
+    The daemon is queried with a bounded concurrency and the sizes and usage
+    totals are written in one transaction. Returns the number of sizes
+    resolved and the last ``ipfs_id`` looked at, which is 0 if there were no
+    more objects after ``after_id``.
+    """
+    rows = (
+        db.session.query(Ipfs.ipfs_id, Ipfs.pin_hash)
+        .filter(Ipfs.size == None)
+        .filter(Ipfs.date_unpinned == None)
+        .filter(Ipfs.ipfs_id > after_id)
+        .order_by(Ipfs.ipfs_id.asc())
+        .limit(app.config.get("SIZE_RESOLVE_BATCH", 1000))
+        .all()
+    )
+    db.session.commit()
+    if not rows:
+        return 0, 0
+    with ThreadPoolExecutor(
+        max_workers=app.config.get("SIZE_RESOLVE_CONCURRENCY", 8)
+    ) as executor:
+        results = dict(
+            zip(
+                [ipfs_id for ipfs_id, _ in rows],
+                executor.map(_object_size, [pin_hash for _, pin_hash in rows]),
+            )
+        )
+    sizes: Dict[int, int] = {
+        ipfs_id: size for ipfs_id, size in results.items() if size is not None
+    }
+
+    # lock the rows still pending, as they may have been unpinned meanwhile
+    deltas: Dict[str, Tuple[int, int]] = {}
+    ipfs_ids: List[int] = []
+    for ipfs_id, user_id in (
+        db.session.query(Ipfs.ipfs_id, Ipfs.user_id)
+        .filter(Ipfs.ipfs_id.in_(list(sizes)))
+        .filter(Ipfs.size == None)
+        .filter(Ipfs.date_unpinned == None)
+        .with_for_update()
+    ):
+        ipfs_ids.append(ipfs_id)
+        count, total = deltas.get(user_id, (0, 0))
+        deltas[user_id] = (count, total + sizes[ipfs_id])
+    if ipfs_ids:
+        ipfs_id_column: Any = Ipfs.ipfs_id
+        db.session.query(Ipfs).filter(ipfs_id_column.in_(ipfs_ids)).update(
+            {
+                Ipfs.size: case(
+                    {ipfs_id: sizes[ipfs_id] for ipfs_id in ipfs_ids},
+                    value=ipfs_id_column,
+                )
+            },
+            synchronize_session=False,
+        )
+        _update_usage(deltas)
+        _bump_changes()
+    db.session.commit()
+    return len(ipfs_ids), rows[-1][0]
+
+
+class _SizeResolver:
+    """ resolves pending sizes a batch at a time, working through the table """
+
+    def __init__(self) -> None:
+        self._after_id = 0
+
+    def tick(self) -> None:
+        """ resolve the next batch, and update the backlog """
+        _, self._after_id = resolve_sizes(self._after_id)
+        PIN_SIZE_BACKLOG.set(
+            db.session.query(Ipfs.ipfs_id)
+            .filter(Ipfs.size == None)
+            .filter(Ipfs.date_unpinned == None)
+            .count()
+        )
+        db.session.commit()
+
+
+def run() -> None:
+    """ process queued jobs until interrupted """
+    runners = [
+        _JobRunner(
+            _claim_pin_jobs,
+            _process_pin_job,
+            concurrency=app.config.get("PIN_JOB_CONCURRENCY", 4),
+        ),
+        _JobRunner(
+            _claim_ipns_publishes,
+            _process_ipns_publish,
+            concurrency=app.config.get("IPNS_PUBLISH_CONCURRENCY", 2),
+        ),
+    ]
+    tasks = [
+        _PeriodicTask(reconcile_pins, app.config.get("PIN_RECONCILE_INTERVAL", 3600)),
+        _PeriodicTask(refresh_ipns_records, 60),
+        _PeriodicTask(expire_upload_sessions, 3600),
+        _PeriodicTask(
+            _SizeResolver().tick, app.config.get("SIZE_RESOLVE_INTERVAL", 10)
+        ),
+        _PeriodicTask(
+            _GarbageScheduler(app.config.get("GC_MIN_INTERVAL", 3600)).tick,
+            app.config.get("GC_CHECK_INTERVAL", 300),
+        ),
+    ]
+    while True:
+        for task in tasks:
+            task.tick()
+        busy = False
+        for runner in runners:
+            if runner.tick():
+                busy = True
+        if not busy:
+            time.sleep(app.config.get("WORKER_POLL_INTERVAL", 5))
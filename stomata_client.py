@@ -0,0 +1,429 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+#
+# pylint: disable=invalid-name,too-many-branches,too-many-statements,too-many-arguments,unused-argument
+
+"""Toy client for testing Stomata.
+
+It only needs requests rather than the server and its configuration. This can
+also be used as a library, for example:
+
+    client = StomataClient("http://127.0.0.1:5000", "Foo", "Bar")
+    client.add("QmHash", name="foo.cab")
+"""
+
+import os
+import sys
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from urllib.parse import urljoin
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class StomataClient:
+    """A client for the Stomata API.
+
+    Connections are kept alive and shared between requests. Requests that
+    fail to connect are retried with an exponential backoff, as are
+    idempotent requests that fail with a temporary server error; a POST is
+    never sent twice once the server may have received it.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        api_key: str,
+        secret_api_key: str,
+        pool_size: int = 10,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 300,
+    ) -> None:
+        self.host = host
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(
+            {
+                "pinata_api_key": api_key,
+                "pinata_secret_api_key": secret_api_key,
+            }
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=[429, 502, 503, 504],
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.hooks["response"].append(self._count_sent)
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    def _count_sent(self, r: requests.Response, *args: Any, **kwargs: Any) -> None:
+        """ count the request bodies actually sent, including each upload chunk """
+        with self._lock:
+            self.bytes_sent += len(r.request.body or b"")
+
+    def _request(self, method: str, path: str, **kwargs: Any) -> requests.Response:
+        return self.session.request(
+            method, urljoin(self.host, path), timeout=self.timeout, **kwargs
+        )
+
+    def ls(self) -> requests.Response:
+        """ list the pins """
+        return self._request("GET", "data/pinList")
+
+    def rm(self, ipfs_hash: str) -> requests.Response:
+        """ unpin an object """
+        return self._request("DELETE", "pinning/unpin/{}".format(ipfs_hash))
+
+    def add(
+        self,
+        ipfs_hash: str,
+        name: Optional[str] = None,
+        keyvalues: Optional[Dict[str, Any]] = None,
+    ) -> requests.Response:
+        """ pin an existing object """
+        md: Dict[str, Any] = {}
+        if name:
+            md["name"] = name
+        if keyvalues:
+            md["keyvalues"] = keyvalues
+        return self._request(
+            "POST",
+            "pinning/pinByHash",
+            json={"hashToPin": ipfs_hash, "pinataMetadata": md},
+        )
+
+    def md(self, ipfs_hash: str, keyvalues: Dict[str, Any]) -> requests.Response:
+        """ set metadata, where a value of None removes the key """
+        return self._request(
+            "PUT",
+            "pinning/hashMetadata",
+            json={"ipfsPinHash": ipfs_hash, "keyvalues": keyvalues},
+        )
+
+    def name(self, ipfs_hash: str, name: str) -> requests.Response:
+        """ set the name of an object """
+        return self._request(
+            "PUT",
+            "pinning/hashMetadata",
+            json={"ipfsPinHash": ipfs_hash, "name": name},
+        )
+
+    def pub(self, ipfs_hash: str) -> requests.Response:
+        """ publish an object using IPNS """
+        return self._request(
+            "POST", "publishing/publishByHash", json={"hashToPublish": ipfs_hash}
+        )
+
+    def file(
+        self, filename: str, keyvalues: Optional[Dict[str, Any]] = None
+    ) -> requests.Response:
+        """ upload and pin a file """
+        with open(filename, "rb") as f:
+            return self._request(
+                "POST",
+                "pinning/pinFileToIPFS",
+                files={
+                    "file": (
+                        filename,
+                        f,
+                        "application/vnd.ms-cab-compressed",
+                        {
+                            "name": filename,
+                            "keyvalues": keyvalues or {},
+                        },
+                    )
+                },
+            )
+
+    def file_resumable(
+        self,
+        filename: str,
+        keyvalues: Optional[Dict[str, Any]] = None,
+        upload_id: Optional[int] = None,
+        chunk_size: int = 0x800000,
+        jobs: int = 4,
+        on_upload_id: Optional[Callable[[int], None]] = None,
+    ) -> requests.Response:
+        """ upload a file in chunks, several at a time, resuming if possible """
+
+        size = os.path.getsize(filename)
+        done: Set[Tuple[int, int]] = set()
+        if upload_id:
+            r = self._request("GET", "pinning/uploads/{}".format(upload_id))
+            if r.status_code != 200:
+                return r
+            for chunk in r.json()["chunks"]:
+                done.add((chunk["offset"], chunk["length"]))
+        else:
+            r = self._request(
+                "POST",
+                "pinning/uploads",
+                json={
+                    "size": size,
+                    "pinataMetadata": {"name": filename, "keyvalues": keyvalues or {}},
+                },
+            )
+            if r.status_code != 200:
+                return r
+            upload_id = int(r.json()["id"])
+            if on_upload_id:
+                on_upload_id(upload_id)
+
+        def _upload_chunk(offset: int) -> requests.Response:
+            with open(filename, "rb") as f:
+                f.seek(offset)
+                buf = f.read(chunk_size)
+            return self._request(
+                "PUT",
+                "pinning/uploads/{}".format(upload_id),
+                headers={
+                    "Upload-Offset": str(offset),
+                    "Upload-Checksum": "sha256 {}".format(
+                        hashlib.sha256(buf).hexdigest()
+                    ),
+                },
+                data=buf,
+            )
+
+        offsets = [
+            offset
+            for offset in range(0, size, chunk_size)
+            if (offset, min(chunk_size, size - offset)) not in done
+        ]
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for r in executor.map(_upload_chunk, offsets):
+                if r.status_code != 200:
+                    return r
+        return self._request("POST", "pinning/uploads/{}/finalize".format(upload_id))
+
+
+def run_batch(
+    client: StomataClient,
+    func: Callable[[Any], Optional[requests.Response]],
+    items: Iterable[Any],
+    jobs: int = 4,
+) -> Dict[str, Any]:
+    """Call a client method for each item using a bounded number of threads.
+
+    Returns a summary of the number of requests, failures and throughput. The
+    bytes are those the client sent, so chunks that a resumed upload already
+    had are not counted.
+    """
+    lock = threading.Lock()
+    summary: Dict[str, Any] = {"requests": 0, "failed": 0}
+    bytes_sent = client.bytes_sent
+
+    def _run(item: Any) -> None:
+        try:
+            r = func(item)
+        except requests.RequestException as e:
+            r = None
+            print("{}: {}".format(item, str(e)))
+        with lock:
+            summary["requests"] += 1
+            if r is None or r.status_code != 200:
+                summary["failed"] += 1
+            if r is not None:
+                print("{}: {} {}".format(item, r.status_code, " ".join(r.text.split())))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for _ in executor.map(_run, items):
+            pass
+    summary["elapsed"] = time.perf_counter() - start
+    summary["bytes"] = client.bytes_sent - bytes_sent
+    return summary
+
+
+def _client_command(
+    client: StomataClient, args: Any, argv: List[str]
+) -> Optional[requests.Response]:
+
+    if args.command == "ls":
+        return client.ls()
+    if args.command == "rm":
+        try:
+            ipfs_hash = argv[0]
+        except IndexError as _:
+            print("Argument required: IPFS_HASH")
+            return None
+        return client.rm(ipfs_hash)
+    if args.command == "add":
+        try:
+            ipfs_hash = argv[0]
+        except IndexError as _:
+            print("Argument required: IPFS_HASH [NAME] [KEY] [VALUE]")
+            return None
+        name: Optional[str] = None
+        keyvalues: Dict[str, Any] = {}
+        try:
+            name = argv[1]
+            keyvalues = {argv[2]: argv[3]}
+        except IndexError as _:
+            pass
+        return client.add(ipfs_hash, name=name, keyvalues=keyvalues)
+    if args.command == "md":
+        try:
+            ipfs_hash = argv[0]
+            key = argv[1]
+        except IndexError as _:
+            print("Argument required: IPFS_HASH KEY [VALUE]")
+            return None
+        try:
+            keyvalues = {key: argv[2]}
+        except IndexError as _:
+            keyvalues = {key: None}
+        return client.md(ipfs_hash, keyvalues)
+    if args.command == "name":
+        try:
+            ipfs_hash = argv[0]
+            name = argv[1]
+        except IndexError as _:
+            print("Argument required: IPFS_HASH NAME")
+            return None
+        return client.name(ipfs_hash, name)
+    if args.command == "pub":
+        try:
+            ipfs_hash = argv[0]
+        except IndexError as _:
+            print("Argument required: IPFS_HASH")
+            return None
+        return client.pub(ipfs_hash)
+    if args.command == "file":
+        try:
+            filename = argv[0]
+        except IndexError as _:
+            print("Argument required: FILENAME [KEY VALUE]")
+            return None
+        keyvalues = {}
+        try:
+            if argv[1] == "bannedCountryCodes":
+                keyvalues = {argv[1]: argv[2].split(",")}
+            else:
+                keyvalues = {argv[1]: argv[2]}
+        except IndexError as _:
+            pass
+        if args.resumable:
+            return client.file_resumable(
+                filename,
+                keyvalues,
+                upload_id=args.upload_id,
+                chunk_size=args.chunk_size,
+                jobs=args.jobs,
+                on_upload_id=lambda upload_id: print("upload id", upload_id),
+            )
+        return client.file(filename, keyvalues)
+    print("unknown command")
+    sys.exit(1)
+
+
+def _client_run(args: Any, argv: List[str]) -> None:
+
+    client = StomataClient(
+        args.host, args.api_key, args.secret_api_key, pool_size=args.jobs
+    )
+
+    # one request for each line of the batch, with the same arguments as argv
+    if args.batch:
+        if args.batch == "-":
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(args.batch, encoding="utf8") as f:
+                lines = f.read().splitlines()
+        summary = run_batch(
+            client,
+            lambda line: _client_command(client, args, line.split()),
+            [line for line in lines if line.strip()],
+            jobs=args.jobs,
+        )
+        elapsed = summary["elapsed"] or 1e-9
+        print(
+            "{} requests, {} failed, in {:.2f}s: {:.1f} requests/s, {:.1f} KiB/s".format(
+                summary["requests"],
+                summary["failed"],
+                summary["elapsed"],
+                summary["requests"] / elapsed,
+                summary["bytes"] / elapsed / 1024,
+            )
+        )
+        if summary["failed"]:
+            sys.exit(1)
+        return
+
+    r = _client_command(client, args, argv)
+    if r is None:
+        return
+    print(r.text)
+    print("status code", r.status_code)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--host",
+        default=os.environ.get("HOST", "http://127.0.0.1:5000"),
+        help="Server URI",
+    )
+    parser.add_argument(
+        "--api-key",
+        default=os.environ.get("API_KEY", "Foo"),
+        help="Service API key",
+    )
+    parser.add_argument(
+        "--secret-api-key",
+        default=os.environ.get("SECRET_API_KEY", "Bar"),
+        help="Service secret API key",
+    )
+    parser.add_argument(
+        "--batch",
+        help="File of arguments to run the command with, one per line, or - for stdin",
+    )
+    parser.add_argument(
+        "--resumable",
+        action="store_true",
+        help="Upload files in chunks that can be resumed",
+    )
+    parser.add_argument(
+        "--upload-id",
+        type=int,
+        help="Resumable upload to continue",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=0x800000,
+        help="Size of each resumable upload chunk",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=4,
+        help="Number of batch requests or upload chunks to send at the same time",
+    )
+    parser.add_argument(
+        "command",
+        choices=["ls", "name", "rm", "pin", "add", "md", "ls", "pub", "file"],
+        help="Command to run",
+    )
+    _args, _argv = parser.parse_known_args()
+    _client_run(_args, _argv)
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+#
+# pylint: disable=invalid-name,missing-function-docstring
+
+""" tests for the netblock to CIDR decomposition and the ipset script """
+
+import random
+import unittest
+import ipaddress
+from typing import List, Set, Tuple
+
+from iptables import IPSET_NAME, Netblock, _ipset_restore
+
+_ADDR_MAX = 0xFFFFFFFF
+
+
+def _reference(addr_from: int, addr_to: int) -> List[Tuple[int, int]]:
+    return [
+        (int(net.network_address), net.prefixlen)
+        for net in ipaddress.summarize_address_range(
+            ipaddress.IPv4Address(addr_from), ipaddress.IPv4Address(addr_to)
+        )
+    ]
+
+
+def _random_range(rnd: random.Random) -> Tuple[int, int]:
+    # mix arbitrary ranges with ones near alignment boundaries and the ends
+    kind = rnd.randrange(4)
+    if kind == 0:
+        addr_from = rnd.randint(0, _ADDR_MAX)
+        return addr_from, rnd.randint(addr_from, _ADDR_MAX)
+    if kind == 1:
+        addr_from = rnd.randint(0, _ADDR_MAX)
+        return addr_from, min(addr_from + rnd.randint(0, 0x1000), _ADDR_MAX)
+    if kind == 2:
+        size = 1 << rnd.randint(0, 31)
+        addr_from = rnd.randint(0, _ADDR_MAX // size) * size + rnd.randint(-1, 1)
+        addr_from = max(0, min(addr_from, _ADDR_MAX))
+        addr_to = addr_from + max(size + rnd.randint(-2, 2), 0)
+        return addr_from, min(addr_to, _ADDR_MAX)
+    addr_to = _ADDR_MAX - rnd.randint(0, 0x10000)
+    return rnd.choice([0, rnd.randint(0, addr_to)]), addr_to
+
+
+class NetblockCidrsTest(unittest.TestCase):
+    def test_edges(self) -> None:
+        self.assertEqual(Netblock(0, _ADDR_MAX).cidrs, [(0, 0)])
+        self.assertEqual(Netblock(0, 0).cidrs, [(0, 32)])
+        self.assertEqual(Netblock(_ADDR_MAX, _ADDR_MAX).cidrs, [(_ADDR_MAX, 32)])
+        self.assertEqual(Netblock(1, _ADDR_MAX).cidrs, _reference(1, _ADDR_MAX))
+        self.assertEqual(Netblock(0x01000000, 0x010000FF).cidrs, [(0x01000000, 24)])
+        self.assertEqual(
+            Netblock(0x01000001, 0x01000100).cidrs,
+            _reference(0x01000001, 0x01000100),
+        )
+
+    def test_properties(self) -> None:
+        rnd = random.Random(0x57014A7A)
+        for _ in range(20000):
+            addr_from, addr_to = _random_range(rnd)
+            cidrs = Netblock(addr_from, addr_to).cidrs
+
+            # the blocks are aligned, contiguous and cover exactly the range
+            addr = addr_from
+            for network, prefix in cidrs:
+                size = 1 << (32 - prefix)
+                self.assertEqual(network, addr)
+                self.assertEqual(network % size, 0)
+                addr += size
+            self.assertEqual(addr, addr_to + 1)
+
+            # and there are as few as possible
+            self.assertEqual(cidrs, _reference(addr_from, addr_to))
+
+
+class IpsetRestoreTest(unittest.TestCase):
+    def test_new_set_is_always_created(self) -> None:
+        netblocks = [Netblock(0x01000000, 0x010000FF)]
+        existing_sets: List[Set[str]] = [
+            set(),
+            {IPSET_NAME},
+            {IPSET_NAME, IPSET_NAME + "-new"},
+        ]
+        for existing in existing_sets:
+            lines = _ipset_restore(netblocks, existing).splitlines()
+            creates = [line for line in lines if line.startswith("create ")]
+            self.assertEqual(len(creates), 1)
+            self.assertTrue(creates[0].startswith("create {}-new ".format(IPSET_NAME)))
+            self.assertNotIn("-exist", creates[0])
+            self.assertIn("add {}-new 1.0.0.0/24".format(IPSET_NAME), lines)
+            if IPSET_NAME + "-new" in existing:
+                self.assertEqual(lines[0], "destroy {}-new".format(IPSET_NAME))
+            if IPSET_NAME in existing:
+                self.assertEqual(
+                    lines[-2:],
+                    [
+                        "swap {0}-new {0}".format(IPSET_NAME),
+                        "destroy {}-new".format(IPSET_NAME),
+                    ],
+                )
+            else:
+                self.assertEqual(lines[-1], "rename {0}-new {0}".format(IPSET_NAME))
+
+    def test_maxelem_grows(self) -> None:
+        netblocks = [Netblock(i * 4, i * 4 + 2) for i in range(40000)]
+        create = _ipset_restore(netblocks, set()).splitlines()[0]
+        self.assertTrue(create.endswith("maxelem 80000"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021 Richard Hughes <richard@hughsie.com>
+#
+# SPDX-License-Identifier: GPL-2.0+
+#
+# pylint: disable=invalid-name,missing-function-docstring
+
+"""Tests for streaming uploads through to the daemon.
+
+The routes that write use PostgreSQL upserts, so these only run when
+STOMATA_TEST_DATABASE is set to a throwaway PostgreSQL database, e.g.
+postgresql:///stomata_test. The size of the upload can be set using
+STOMATA_TEST_UPLOAD_SIZE, which is 4G by default.
+"""
+
+import os
+import logging
+import resource
+import unittest
+from http.server import ThreadingHTTPServer
+from urllib.parse import urljoin
+
+import requests
+from werkzeug.serving import make_server
+
+from stomata import app, create_schema
+from bench import (
+    FakeIpfsDaemon,
+    _FakeIpfsHandler,
+    _KeepAliveHandler,
+    _multipart_file,
+    _parse_size,
+    _serve,
+)
+
+_DATABASE = os.environ.get("STOMATA_TEST_DATABASE", "")
+
+
+def _peak_rss() -> int:
+    """ get the peak RSS of this process in bytes """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@unittest.skipUnless(
+    _DATABASE.startswith("postgresql"), "STOMATA_TEST_DATABASE is not PostgreSQL"
+)
+class PinFileToIpfsTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.daemon = FakeIpfsDaemon(0)
+        ipfs_server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeIpfsHandler)
+        ipfs_server.daemon = self.daemon  # type: ignore
+        ipfs_server.daemon_threads = True
+        ipfs_port = _serve(ipfs_server)
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        app.config["SQLALCHEMY_DATABASE_URI"] = _DATABASE
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {}
+        app.config["IPFS_API_ADDR"] = "/ip4/127.0.0.1/tcp/{}/http".format(ipfs_port)
+        with app.app_context():
+            create_schema()
+        app_server = make_server(
+            "127.0.0.1", 0, app, threaded=True, request_handler=_KeepAliveHandler
+        )
+        self.host = "http://127.0.0.1:{}/".format(_serve(app_server))
+        self.servers = [ipfs_server, app_server]
+
+    def tearDown(self) -> None:
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_large_upload_memory_is_bounded(self) -> None:
+        size = _parse_size(os.environ.get("STOMATA_TEST_UPLOAD_SIZE", "4G"))
+        boundary = os.urandom(16).hex()
+        rss_before = _peak_rss()
+        r = requests.post(
+            urljoin(self.host, "pinning/pinFileToIPFS"),
+            data=_multipart_file(size, boundary),
+            headers={
+                "Content-Type": "multipart/form-data; boundary=" + boundary,
+                "pinata_api_key": app.config["STOMATA_API_KEY"],
+                "pinata_secret_api_key": app.config["STOMATA_SECRET_API_KEY"],
+            },
+            timeout=600,
+        )
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual(r.json()["PinSize"], size)
+        self.assertEqual(self.daemon.sizes[r.json()["IpfsHash"]], size)
+
+        # the request, the app and the daemon all run in this process, so
+        # nothing may have buffered more than a small part of the upload
+        self.assertLess(_peak_rss() - rss_before, 128 << 20)
+
+
+if __name__ == "__main__":
+    unittest.main()